@@ -1,14 +1,112 @@
 # code originally written by Andreas Niskanen (andreas.niskanen@helsinki.fi)
-from . util import calc_prog_size, reduce_prog, prog_is_recursive, prog_has_invention, calc_rule_size, rule_is_recursive, format_prog
+from . util import calc_prog_size, reduce_prog, prog_is_recursive, prog_has_invention, calc_rule_size, rule_is_recursive, format_prog, format_rule
 from collections import defaultdict
 from . import maxsat
 from pysat.formula import IDPool
+import gzip
+import json
+import os
 import time
 import bitarray
+from bitarray.util import subset, count_and, zeros
+import heapq
 
 POS_EXAMPLE_WEIGHT = 1
 NEG_EXAMPLE_WEIGHT = 1
 
+# a program of one rule is dominated by another program if the other covers at least the same positive examples, at most the same negative examples, and is no larger. swapping the dominated program for the other in a combination never makes it worse, so we do not encode dominated programs. this argument needs the coverage of a combination to be the union of the coverage of its programs, so we only use it without recursion and predicate invention
+class DominanceFilter:
+    def __init__(self, coverage_pos, coverage_neg, prog_lookup):
+        self.coverage_pos = coverage_pos
+        self.coverage_neg = coverage_neg
+        self.prog_lookup = prog_lookup
+        # the programs that no other program dominates
+        self.kept = set()
+        # a dominated program to the kept program that dominates it, and the reverse
+        self.dominated_by = {}
+        self.dominates = defaultdict(set)
+        # the coverage and size of every program we have seen, as the loop deletes the coverage of programs it removes
+        self.scores = {}
+        # the kept programs that cover each example and the kept programs by their first covered example
+        self.covered_by = defaultdict(set)
+        self.first_covered = defaultdict(set)
+
+    def is_dominated(self, prog_hash, other):
+        pos1, neg1, size1 = self.scores[prog_hash]
+        pos2, neg2, size2 = self.scores[other]
+        return size1 >= size2 and subset(pos1, pos2) and subset(neg2, neg1)
+
+    def keep(self, prog_hash):
+        pos, _, _ = self.scores[prog_hash]
+        self.kept.add(prog_hash)
+        for ex in pos.search(1):
+            self.covered_by[ex].add(prog_hash)
+        self.first_covered[pos.find(1)].add(prog_hash)
+
+    def unkeep(self, prog_hash):
+        pos, _, _ = self.scores[prog_hash]
+        self.kept.discard(prog_hash)
+        for ex in pos.search(1):
+            self.covered_by[ex].discard(prog_hash)
+        self.first_covered[pos.find(1)].discard(prog_hash)
+
+    def set_dominated(self, prog_hash, other):
+        self.dominated_by[prog_hash] = other
+        self.dominates[other].add(prog_hash)
+        # the programs that prog_hash dominates are also dominated by other
+        for x in self.dominates.pop(prog_hash, ()):
+            self.dominated_by[x] = other
+            self.dominates[other].add(x)
+
+    def insert(self, prog_hash):
+        if prog_hash not in self.scores:
+            pos = self.coverage_pos[prog_hash]
+            self.scores[prog_hash] = pos, self.coverage_neg[prog_hash], calc_prog_size(self.prog_lookup[prog_hash])
+        pos, _, _ = self.scores[prog_hash]
+
+        if not pos.any():
+            self.kept.add(prog_hash)
+            return
+
+        if len(self.prog_lookup[prog_hash]) == 1:
+            # a program that dominates this one covers its rarest example
+            ex = min(pos.search(1), key=lambda ex: len(self.covered_by[ex]))
+            for other in self.covered_by[ex]:
+                if self.is_dominated(prog_hash, other):
+                    self.set_dominated(prog_hash, other)
+                    return
+
+        # a program that this one dominates has its first example in the examples of this one
+        for ex in pos.search(1):
+            for other in list(self.first_covered[ex]):
+                if len(self.prog_lookup[other]) == 1 and self.is_dominated(other, prog_hash):
+                    self.unkeep(other)
+                    self.set_dominated(other, prog_hash)
+
+        self.keep(prog_hash)
+
+    def update(self, progs):
+        removed = self.scores.keys() - progs
+        orphans = set()
+        for prog_hash in removed:
+            if prog_hash in self.dominated_by:
+                other = self.dominated_by.pop(prog_hash)
+                if other in self.dominates:
+                    self.dominates[other].discard(prog_hash)
+            else:
+                self.unkeep(prog_hash)
+                orphans.update(self.dominates.pop(prog_hash, ()))
+            del self.scores[prog_hash]
+
+        # programs whose dominating program has gone
+        for prog_hash in orphans - removed:
+            del self.dominated_by[prog_hash]
+            self.insert(prog_hash)
+
+        for prog_hash in progs:
+            if prog_hash not in self.scores:
+                self.insert(prog_hash)
+
 class Combiner:
     def __init__(self, settings, tester, coverage_pos, coverage_neg, prog_lookup):
         self.settings = settings
@@ -19,123 +117,241 @@ class Combiner:
         self.coverage_pos = coverage_pos
         self.coverage_neg = coverage_neg
         self.prog_lookup = prog_lookup
+        self.dominance = None
+        if not settings.recursion_enabled and not settings.pi_enabled:
+            self.dominance = DominanceFilter(coverage_pos, coverage_neg, prog_lookup)
+        self.num_captured = 0
+        # the state that greedy_combination keeps between calls
+        self.greedy_heap = []
+        self.greedy_progs = set()
+        self.greedy_steps = []
+        self.greedy_uncovered = ~zeros(tester.num_pos)
+        self.reset_encoding()
+
+    # we keep the encoding between calls and only encode the programs saved since the last call. the loop removes programs from saved_progs, which we handle by disabling their rule or, if we cannot, by starting again
+    def reset_encoding(self):
+        self.vpool = IDPool()
+        self.rulehash_to_id = {}
+        self.ruleid_to_rule = {}
+        self.ruleid_to_size = {}
+        self.rule_var = {}
+        # the number of encoded programs that use each rule
+        self.rule_count = defaultdict(int)
+        self.base_rules = []
+        self.recursive_rules = []
+        # program hash to its variable and rule ids
+        self.encoded_progs = {}
+        self.disabled_rules = set()
+        self.encoded_inconsistent = set()
+        # hard clauses that only ever grow, such as the program definitions
+        self.hard_clauses = []
+
+        # examples covered by exactly the same programs share one variable whose soft clause is weighted by the number of such examples. each pattern has a variable, a weight, and the programs that cover its examples. a new program splits the patterns whose examples it only partly covers
+        self.pos_pattern_of = [0] * self.tester.num_pos
+        self.neg_pattern_of = [0] * self.tester.num_neg
+        self.pos_pattern_var = []
+        self.neg_pattern_var = []
+        self.pos_pattern_weight = []
+        self.neg_pattern_weight = []
+        # the clause for each positive pattern, to which we append the variables of the programs that cover it
+        self.pos_pattern_clause = []
+        self.neg_pattern_progs = []
+
+        if self.tester.num_pos > 0:
+            self.add_pos_pattern(self.tester.num_pos, [])
+        if self.settings.noisy and self.tester.num_neg > 0:
+            self.add_neg_pattern(self.tester.num_neg, [])
+
+    def add_pos_pattern(self, weight, pvars):
+        var = self.vpool.id("pos_example_covered({0})".format(len(self.pos_pattern_var)))
+        self.pos_pattern_var.append(var)
+        self.pos_pattern_weight.append(weight)
+        self.pos_pattern_clause.append([-var] + pvars)
+        return len(self.pos_pattern_var) - 1
+
+    def add_neg_pattern(self, weight, pvars):
+        var = self.vpool.id("neg_example_covered({0})".format(len(self.neg_pattern_var)))
+        self.neg_pattern_var.append(var)
+        self.neg_pattern_weight.append(weight)
+        self.neg_pattern_progs.append(pvars)
+        for pvar in pvars:
+            self.hard_clauses.append([var, -pvar])
+        return len(self.neg_pattern_var) - 1
+
+    # groups the examples a program covers by their pattern
+    def covered_patterns(self, covered, pattern_of):
+        groups = defaultdict(list)
+        for ex in covered.search(1):
+            groups[pattern_of[ex]].append(ex)
+        return groups.items()
 
     def add_inconsistent(self, prog_hash):
         self.inconsistent.add(prog_hash)
 
-    def find_combination(self, timeout):
-        encoding = []
-
-        rulehash_to_id = {}
-        ruleid_to_rule = {}
-        ruleid_to_size = {}
-        rule_var = {}
-
-        base_rules = []
-        recursive_rules = []
-
-        programs_covering_pos_example = {}
-        programs_covering_neg_example = {}
-        program_var = {}
-        program_clauses = {}
-        vpool = IDPool()
-
-        pos_example_covered_var = {}
-        neg_example_covered_var = {}
+    def encode_prog(self, prog_hash):
+        vpool = self.vpool
+        rulehash_to_id = self.rulehash_to_id
+        rule_var = self.rule_var
+        prog = self.prog_lookup[prog_hash]
+
+        pos_covered = self.coverage_pos[prog_hash]
+        neg_covered = self.coverage_neg[prog_hash]
+
+        # UNCOMMENT TO SHOW PROGRAMS ADDED TO THE SOLVER
+        # tp = len(pos_covered)
+        # fp = len(neg_covered)
+        # size = calc_prog_size(prog)
+        # fn = self.tester.num_pos - tp
+        # print(f'size: {size} fp:{fp} tp:{tp} mdl:{size + fp + fn} {format_prog(prog)}')
+        # print(sorted(pos_covered))
+
+        rule_vars = []
+        ids = []
+        for rule in prog:
+            rule_hash = hash(rule)
+            if rule_hash not in rulehash_to_id:
+                k = len(rulehash_to_id) + 1
+                rulehash_to_id[rule_hash] = k
+                self.ruleid_to_rule[k] = rule
+                self.ruleid_to_size[k] = calc_rule_size(rule)
+                rule_var[k] = vpool.id("rule({0}))".format(k))
+                if self.settings.lex and self.settings.recursion_enabled:
+                    if rule_is_recursive(rule):
+                        self.recursive_rules.append(k)
+                    else:
+                        self.base_rules.append(k)
+            rule_id = rulehash_to_id[rule_hash]
+            ids.append(rule_id)
+            rule_vars.append(rule_var[rule_id])
+            self.rule_count[rule_id] += 1
+
+        if len(rule_vars) == 1:
+            pvar = rule_vars[0]
+        else:
+            pvar = vpool.id("program({0})".format(prog_hash))
+            self.hard_clauses.append([pvar] + [-var for var in rule_vars])
+            for var in rule_vars:
+                self.hard_clauses.append([-pvar, var])
 
-        pos_index = list(range(self.tester.num_pos))
-        neg_index = list(range(self.tester.num_neg))
+        self.encoded_progs[prog_hash] = pvar, ids
 
-        for i in pos_index:
-            pos_example_covered_var[i] = vpool.id("pos_example_covered({0})".format(i))
-            programs_covering_pos_example[i] = []
+        for pattern, xs in self.covered_patterns(pos_covered, self.pos_pattern_of):
+            if len(xs) == self.pos_pattern_weight[pattern]:
+                self.pos_pattern_clause[pattern].append(pvar)
+                continue
+            self.pos_pattern_weight[pattern] -= len(xs)
+            new_pattern = self.add_pos_pattern(len(xs), self.pos_pattern_clause[pattern][1:] + [pvar])
+            for ex in xs:
+                self.pos_pattern_of[ex] = new_pattern
 
         if self.settings.noisy:
-            for i in neg_index:
-                neg_example_covered_var[i] = vpool.id("neg_example_covered({0})".format(i))
-                programs_covering_neg_example[i] = []
-
-        rule_var = {}
-
-        for program_count, prog_hash in enumerate(self.saved_progs):
-
-            prog = self.prog_lookup[prog_hash]
-
-            pos_covered = self.coverage_pos[prog_hash]
-            neg_covered = self.coverage_neg[prog_hash]
-
-            # UNCOMMENT TO SHOW PROGRAMS ADDED TO THE SOLVER
-            # tp = len(pos_covered)
-            # fp = len(neg_covered)
-            # size = calc_prog_size(prog)
-            # fn = self.tester.num_pos - tp
-            # print(f'size: {size} fp:{fp} tp:{tp} mdl:{size + fp + fn} {format_prog(prog)}')
-            # print(sorted(pos_covered))
-
-            for ex, x in enumerate(pos_covered):
-                if x == 1:
-                    # AC: REALLY REALLY HACKY
-                    # WE NEED TO +1 BECAUSE OF POS_INDEX BELOW
-                    programs_covering_pos_example[ex].append(program_count)
-
-            if self.settings.noisy:
-                for ex, x in enumerate(neg_covered):
-                    if x == 1:
-                        programs_covering_neg_example[ex].append(program_count)
-
-            rule_vars = []
-            ids = []
-            for rule in prog:
-                rule_hash = hash(rule)
-                if rule_hash not in rulehash_to_id:
-                    k = len(rulehash_to_id) + 1
-                    rulehash_to_id[rule_hash] = k
-                    ruleid_to_rule[k] = rule
-                    ruleid_to_size[k] = calc_rule_size(rule)
-                    ids.append(k)
-                else:
-                    ids.append(rulehash_to_id[rule_hash])
-
-            for rule in prog:
-                rule_hash = hash(rule)
-                rule_id = rulehash_to_id[rule_hash]
-                rule_size = ruleid_to_size[rule_id]
+            for pattern, xs in self.covered_patterns(neg_covered, self.neg_pattern_of):
+                if len(xs) == self.neg_pattern_weight[pattern]:
+                    self.neg_pattern_progs[pattern].append(pvar)
+                    self.hard_clauses.append([self.neg_pattern_var[pattern], -pvar])
+                    continue
+                self.neg_pattern_weight[pattern] -= len(xs)
+                new_pattern = self.add_neg_pattern(len(xs), self.neg_pattern_progs[pattern] + [pvar])
+                for ex in xs:
+                    self.neg_pattern_of[ex] = new_pattern
+
+    # a program that the loop has removed from saved_progs. if its only rule is in no other program, we disable the rule, which is the same as never having encoded the program
+    def remove_prog(self, prog_hash):
+        _, ids = self.encoded_progs[prog_hash]
+        for rule_id in ids:
+            self.rule_count[rule_id] -= 1
+        if len(ids) != 1 or self.rule_count[ids[0]] > 0:
+            return False
+        self.hard_clauses.append([-self.rule_var[ids[0]]])
+        del self.encoded_progs[prog_hash]
+        self.disabled_rules.add(hash(self.ruleid_to_rule[ids[0]]))
+        return True
+
+    # the combiner only returns a solution better than the best one so far. if this needs a smaller size than a program has, no better solution uses the program, so we do not encode it
+    def size_bound(self):
+        if not self.settings.best_prog_score:
+            return None
+        if not self.settings.lex:
+            return self.settings.best_mdl
+        _, fn_, _, fp_, size_ = self.settings.best_prog_score
+        if fn_ == 0 and (self.settings.nonoise or fp_ == 0):
+            return size_
+        return None
+
+    # the values of the variables in the best solution so far, for the solver to try first
+    def incumbent_phases(self):
+        if not self.settings.solution:
+            return []
+        solution = set(hash(rule) for rule in self.settings.solution)
+        phases = []
+        for rule_id, var in self.rule_var.items():
+            if var is not None:
+                phases.append(var if hash(self.ruleid_to_rule[rule_id]) in solution else -var)
+        phases.extend(self.pos_pattern_var)
+        phases.extend(-var for var in self.neg_pattern_var)
+        return phases
+
+    def update_encoding(self):
+        progs = self.saved_progs
+        if self.dominance is not None:
+            self.dominance.update(self.saved_progs)
+            progs = self.dominance.kept
+
+        bound = self.size_bound()
+        if bound is not None:
+            progs = set(prog_hash for prog_hash in progs if calc_prog_size(self.prog_lookup[prog_hash]) < bound)
+
+        removed = self.encoded_progs.keys() - progs
+        if any(not self.remove_prog(prog_hash) for prog_hash in removed):
+            self.reset_encoding()
+
+        new_progs = [prog_hash for prog_hash in progs if prog_hash not in self.encoded_progs]
+        if self.disabled_rules and any(hash(rule) in self.disabled_rules for prog_hash in new_progs for rule in self.prog_lookup[prog_hash]):
+            self.reset_encoding()
+            new_progs = progs
+
+        for prog_hash in new_progs:
+            self.encode_prog(prog_hash)
 
-                if rule_id not in rule_var:
-                    rule_var[rule_id] = vpool.id("rule({0}))".format(rule_id))
+        # PRUNE INCONSISTENT
+        rulehash_to_id = self.rulehash_to_id
+        for prog in self.inconsistent:
+            if prog in self.encoded_inconsistent:
+                continue
+            if any(hash(rule) not in rulehash_to_id for rule in prog):
+                continue
+            self.encoded_inconsistent.add(prog)
+            self.hard_clauses.append([-self.rule_var[rulehash_to_id[hash(rule)]] for rule in prog])
+
+    # saves the MaxSAT instance of a call so that we can replay it with popper.replay
+    def capture_instance(self, encoding, objective, phases, timeout):
+        rules = []
+        for rule_id, var in self.rule_var.items():
+            if var is not None:
+                rules.append({'var': var, 'size': self.ruleid_to_size[rule_id], 'rule': format_rule(self.ruleid_to_rule[rule_id])})
+        instance = {'lex': self.settings.lex, 'noisy': self.settings.noisy, 'timeout': timeout, 'hard': encoding, 'phases': phases, 'rules': rules}
+        instance.update(objective)
+        self.num_captured += 1
+        os.makedirs(self.settings.capture_combine, exist_ok=True)
+        with gzip.open(os.path.join(self.settings.capture_combine, f'combine-{self.num_captured:05d}.json.gz'), 'wt') as f:
+            json.dump(instance, f)
 
-                rule_vars.append(rule_var[rule_id])
-                if self.settings.lex and self.settings.recursion_enabled:
-                    if rule_is_recursive(rule):
-                        recursive_rules.append(rule_id)
-                    else:
-                        base_rules.append(rule_id)
+    def find_combination(self, timeout):
+        self.update_encoding()
 
-            if len(rule_vars) == 1:
-                program_var[program_count] = rule_vars[0]
-                program_clauses[program_count] = []
-            else:
-                program_var[program_count] = vpool.id("program({0})".format(program_count))
-                pvar = program_var[program_count]
+        rule_var = self.rule_var
+        ruleid_to_rule = self.ruleid_to_rule
+        ruleid_to_size = self.ruleid_to_size
+        rulehash_to_id = self.rulehash_to_id
+        pos_vars = self.pos_pattern_var
+        neg_vars = self.neg_pattern_var
+        pos_weights = self.pos_pattern_weight
+        neg_weights = self.neg_pattern_weight
 
-                clause = [pvar] + [-var for var in rule_vars]
-                encoding.append(clause)
-                program_clauses[program_count] = [clause]
-                for var in rule_vars:
-                    clause = [-pvar, var]
-                    encoding.append(clause)
-                    program_clauses[program_count].append(clause)
+        encoding = self.hard_clauses + self.pos_pattern_clause
 
         if self.settings.lex and self.settings.recursion_enabled:
-            encoding.append([rule_var[rule_id] for rule_id in base_rules])
-
-        for ex in pos_index:
-            encoding.append([-pos_example_covered_var[ex]] + [program_var[p] for p in programs_covering_pos_example[ex]])
-
-        if self.settings.noisy:
-            for ex in neg_index:
-                for p in programs_covering_neg_example[ex]:
-                    encoding.append([neg_example_covered_var[ex], -program_var[p]])
+            encoding.append([rule_var[rule_id] for rule_id in self.base_rules])
 
         soft_clauses = []
         weights = []
@@ -150,58 +366,53 @@ class Combiner:
                 if rule_var[rule_id] is not None:
                     rule_soft_lits.append(-rule_var[rule_id])
                     weights.append(ruleid_to_size[rule_id])
+            pos_group = [var for var in pos_vars], pos_weights
+            neg_group = [-var for var in neg_vars], neg_weights
+            rule_group = rule_soft_lits, weights
             if self.settings.best_prog_score:
                 if fn_ == 0:
-                    for i in pos_index:
-                        encoding.append([pos_example_covered_var[i]])
+                    for var in pos_vars:
+                        encoding.append([var])
                     if fp_ == 0:
                         if not self.settings.nonoise:
-                            for i in neg_index:
-                                encoding.append([-neg_example_covered_var[i]])
-                        soft_lit_groups = [[lit for lit in rule_soft_lits]]
+                            for var in neg_vars:
+                                encoding.append([-var])
+                        soft_lit_groups = [rule_group]
                     else:
-                        soft_lit_groups = [[-neg_example_covered_var[i] for i in neg_index]]
-                        soft_lit_groups.append([lit for lit in rule_soft_lits])
+                        soft_lit_groups = [neg_group, rule_group]
                 else:
-                    soft_lit_groups = [[pos_example_covered_var[i] for i in pos_index]]
+                    soft_lit_groups = [pos_group]
                     if not self.settings.nonoise:
-                        soft_lit_groups.append([-neg_example_covered_var[i] for i in neg_index])
-                    soft_lit_groups.append([lit for lit in rule_soft_lits])
+                        soft_lit_groups.append(neg_group)
+                    soft_lit_groups.append(rule_group)
             else:
-                soft_lit_groups = [[pos_example_covered_var[i] for i in pos_index]]
+                soft_lit_groups = [pos_group]
                 if not self.settings.nonoise:
-                    soft_lit_groups.append([-neg_example_covered_var[i] for i in neg_index])
-                soft_lit_groups.append([lit for lit in rule_soft_lits])
+                    soft_lit_groups.append(neg_group)
+                soft_lit_groups.append(rule_group)
+            weight_groups = [ws for _, ws in soft_lit_groups]
+            soft_lit_groups = [lits for lits, _ in soft_lit_groups]
         else:
             for rule_id in rule_var:
                 if rule_var[rule_id] is not None:
                     soft_clauses.append([-rule_var[rule_id]])
                     weights.append(ruleid_to_size[rule_id])
-            for i in pos_index:
-                soft_clauses.append([pos_example_covered_var[i]])
-                weights.append(POS_EXAMPLE_WEIGHT)
+            for var, weight in zip(pos_vars, pos_weights):
+                soft_clauses.append([var])
+                weights.append(POS_EXAMPLE_WEIGHT * weight)
             if not self.settings.nonoise:
-                for i in neg_index:
-                    soft_clauses.append([-neg_example_covered_var[i]])
-                    weights.append(NEG_EXAMPLE_WEIGHT)
-
-        # PRUNE INCONSISTENT
-        for prog in self.inconsistent:
-            should_add = True
-            ids = []
-            for rule in prog:
-                k = hash(rule)
-                if k not in rulehash_to_id:
-                    should_add = False
-                    break
-                ids.append(k)
-            if not should_add:
-                continue
-            ids = [rulehash_to_id[k] for k in ids]
-            clause = [-rule_var[k] for k in ids]
-            encoding.append(clause)
+                for var, weight in zip(neg_vars, neg_weights):
+                    soft_clauses.append([-var])
+                    weights.append(NEG_EXAMPLE_WEIGHT * weight)
 
         best_prog = []
+        phases = self.incumbent_phases()
+
+        if self.settings.capture_combine:
+            if self.settings.lex:
+                self.capture_instance(encoding, {'soft_lit_groups': soft_lit_groups, 'weight_groups': weight_groups}, phases, timeout)
+            else:
+                self.capture_instance(encoding, {'soft_clauses': soft_clauses, 'weights': weights}, phases, timeout)
         best_fp = False
         best_fn = False
         best_size = False
@@ -215,23 +426,23 @@ class Combiner:
 
             if not self.settings.lex:
                 if timeout is None or self.settings.last_combine_stage:
-                    cost, model = maxsat.exact_maxsat_solve(encoding, soft_clauses, weights, self.settings)
+                    cost, model = maxsat.exact_maxsat_solve(encoding, soft_clauses, weights, self.settings, phases)
                 else:
-                    cost, model = maxsat.anytime_maxsat_solve(encoding, soft_clauses, weights, self.settings, timeout)
+                    cost, model = maxsat.anytime_maxsat_solve(encoding, soft_clauses, weights, self.settings, timeout, phases)
             else:
                 if timeout is None or self.settings.last_combine_stage:
-                    cost, model = maxsat.exact_lex_solve(encoding, soft_lit_groups, weights, self.settings)
+                    cost, model = maxsat.exact_lex_solve(encoding, soft_lit_groups, weight_groups, self.settings, phases)
                 else:
-                    cost, model = maxsat.anytime_lex_solve(encoding, soft_lit_groups, weights, self.settings, timeout)
+                    cost, model = maxsat.anytime_lex_solve(encoding, soft_lit_groups, weight_groups, self.settings, timeout, phases)
 
             if model is None:
                 print("WARNING: No solution found, exit combiner.")
                 break
 
-            fn = sum(1 for i in pos_index if model[pos_example_covered_var[i]-1] < 0)
+            fn = sum(weight for var, weight in zip(pos_vars, pos_weights) if model[var-1] < 0)
             fp = 0
             if not self.settings.nonoise:
-                fp = sum(1 for i in neg_index if model[neg_example_covered_var[i]-1] > 0)
+                fp = sum(weight for var, weight in zip(neg_vars, neg_weights) if model[var-1] > 0)
             size = sum([ruleid_to_size[rule_id] for rule_id in ruleid_to_size if model[rule_var[rule_id]-1] > 0])
 
             if self.settings.lex:
@@ -273,12 +484,113 @@ class Combiner:
                 ids = [rulehash_to_id[hash(rule)] for rule in smaller]
                 clause = [-rule_var[k] for k in ids]
                 encoding.append(clause)
+                # an inconsistent set of rules stays inconsistent, so we keep the clause for later calls
+                self.hard_clauses.append(clause)
 
         best_prog = [ruleid_to_rule[k] for k in best_prog]
         if self.settings.lex:
             return best_prog, (best_fn, best_fp, best_size)
         return best_prog, best_fn + best_fp + best_size
 
+    # a greedy set cover of the positive examples, so the loop can tighten its size bound between calls to the MaxSAT solver. we take the program that covers the most new positive examples per literal. these gains only shrink as we add programs, so the heap keeps each program with the gain it has on its own, and we only recompute the gains of the programs that reach the top. we keep the steps of the last cover, so a call only checks the new programs against them and redoes the cover from the first step that a new or removed program changes. it assumes that the coverage of a combination is the union of the coverage of its programs, so we do not use it with recursion, predicate invention, or in noisy mode, where the gains of the MDL score can grow
+    def greedy_combination(self, new_progs):
+        num_pos, num_neg = self.tester.num_pos, self.tester.num_neg
+        heap = self.greedy_heap
+        steps = self.greedy_steps
+
+        def gain(prog_hash, uncovered):
+            return count_and(self.coverage_pos[prog_hash], uncovered) / calc_prog_size(self.prog_lookup[prog_hash])
+
+        # the programs saved or found since the last call
+        added = (self.saved_progs - self.greedy_progs) | (new_progs - self.greedy_progs)
+        for prog_hash in added:
+            self.greedy_progs.add(prog_hash)
+            heapq.heappush(heap, (-self.coverage_pos[prog_hash].count(1) / calc_prog_size(self.prog_lookup[prog_hash]), prog_hash))
+
+        # the first step whose program the loop has removed or that a new program beats
+        start = None
+        for i, (prog_hash, _, _) in enumerate(steps):
+            if prog_hash not in self.saved_progs and prog_hash not in new_progs:
+                start = i
+                break
+        n = len(steps) if start is None else start
+        for prog_hash in added:
+            for i in range(n):
+                _, g, uncovered = steps[i]
+                if gain(prog_hash, uncovered) > g:
+                    n = start = i
+                    break
+            else:
+                if start is None and count_and(self.coverage_pos[prog_hash], self.greedy_uncovered):
+                    start = n
+        if start is None:
+            return None
+
+        if start < len(steps):
+            uncovered = steps[start][2]
+        else:
+            uncovered = self.greedy_uncovered
+        del steps[start:]
+
+        # the programs whose gain we have recomputed in this call
+        updated = []
+        popped = []
+        while uncovered.any():
+            if updated and (not heap or updated[0] <= heap[0]):
+                _, prog_hash = heapq.heappop(updated)
+            elif heap:
+                x = heapq.heappop(heap)
+                prog_hash = x[1]
+                # the loop has removed the program
+                if prog_hash not in self.saved_progs and prog_hash not in new_progs:
+                    self.greedy_progs.discard(prog_hash)
+                    continue
+                popped.append(x)
+            else:
+                break
+            g = gain(prog_hash, uncovered)
+            top = min(heap[0][0] if heap else 0, updated[0][0] if updated else 0)
+            if -g > top:
+                heapq.heappush(updated, (-g, prog_hash))
+                continue
+            if g <= 0:
+                break
+            steps.append((prog_hash, g, uncovered))
+            uncovered = uncovered & ~self.coverage_pos[prog_hash]
+        self.greedy_uncovered = uncovered
+
+        for x in popped:
+            heapq.heappush(heap, x)
+
+        if uncovered.any():
+            return None
+
+        selected = [prog_hash for prog_hash, _, _ in steps]
+
+        # drop the programs that later programs make redundant, counting how many selected programs cover each example
+        counts = [0] * num_pos
+        for prog_hash in selected:
+            for i in self.coverage_pos[prog_hash].search(1):
+                counts[i] += 1
+        for prog_hash in list(selected):
+            covered = list(self.coverage_pos[prog_hash].search(1))
+            if all(counts[i] > 1 for i in covered):
+                selected.remove(prog_hash)
+                for i in covered:
+                    counts[i] -= 1
+
+        rules = reduce_prog([rule for prog_hash in selected for rule in self.prog_lookup[prog_hash]])
+        size = calc_prog_size(rules)
+        if self.settings.best_prog_score and self.settings.best_prog_score[4] <= size:
+            return None
+
+        neg_covered = zeros(num_neg)
+        for prog_hash in selected:
+            neg_covered |= self.coverage_neg[prog_hash]
+        fp = neg_covered.count(1)
+
+        return rules, (num_pos, 0, num_neg - fp, fp, size)
+
     def update_best_prog(self, new_progs, timeout=None):
         if timeout is None:
             timeout = self.settings.maxsat_timeout
@@ -4,9 +4,9 @@ import clingo
 import numbers
 import clingo.script
 import pkg_resources
-from . util import Constraint, Literal
+from . util import Constraint, Literal, Rule, Program, calc_prog_size, embeds, is_variant, ground_base, vars_encoding, NogoodStore, CoverageHeuristic, COVERAGE_HEURISTIC, SYMMETRY_BREAKING, symmetry_breaking_bkcons, body_literal_table, AtomLiterals, NOGOOD_SIGNATURES, body_var_types, typed_bindings, find_deep_bindings
 from clingo import Function, Number, Tuple_
-from itertools import permutations
+from math import perm, factorial
 
 def arg_to_symbol(arg):
     if isinstance(arg, tuple):
@@ -20,13 +20,13 @@ def atom_to_symbol(pred, args):
     xs = tuple(arg_to_symbol(arg) for arg in args)
     return Function(name = pred, arguments = xs)
 
-DEFAULT_HEURISTIC = """
-#heuristic size(N). [1000-N,true]
-"""
+# constraints with more ground variants than this are passed to clingo as non-ground rules
+MAX_GROUND_VARIANTS = 200
 
-NOISY_ENCODING = """
-program_bounds(0..K):- max_size(K).
-program_size_at_least(M):- size(N), program_bounds(M), M <= N.
+# the constraint on the number of body literals for one program size, grounded when the generator reaches that size
+SIZE_ENCODING = """
+#external size_in_literals(n).
+:- size_in_literals(n), #count{P,Vars : body_literal(0,P,_,Vars)} != n-1.
 """
 
 class Generator:
@@ -34,9 +34,19 @@ class Generator:
     def __init__(self, settings, bkcons=[]):
         self.savings = 0
         self.settings = settings
-        self.cached_clingo_atoms = {}
+        self.nogood_store = NogoodStore(settings.stats)
+        self.coverage = CoverageHeuristic() if settings.coverage_heuristic else None
         self.handle = None
+        self.solve_handle = None
         self.pruned_sizes = set()
+        # non-ground constraints waiting to be grounded
+        self.pending_rules = []
+        self.num_parts = 0
+        # nogoods added during the current solve call and the models it has yielded, which we need to keep if we restart the solve
+        self.solve_nogoods = []
+        self.solve_models = []
+        # a program of a different size found whilst filling a batch
+        self.stash = None
 
         encoding = []
         alan = pkg_resources.resource_string(__name__, "lp/alan.pl").decode()
@@ -61,11 +71,7 @@ class Generator:
         encoding.append(f'head_vars({head_arity}, {tuple(range(head_arity))}).')
         arities = set(a for p, a in self.settings.body_preds)
         arities.add(head_arity)
-        for arity in arities:
-            for xs in permutations(range(settings.max_vars), arity):
-                encoding.append(f'vars({arity}, {tuple(xs)}).')
-                for i, x in enumerate(xs):
-                    encoding.append(f'var_pos({x}, {tuple(xs)}, {i}).')
+        encoding.append(vars_encoding(arities))
 
         type_encoding = set()
         if self.settings.head_types:
@@ -79,7 +85,7 @@ class Generator:
                 str_types = str(types).replace("'","")
                 for i, x in enumerate(types):
                     type_encoding.add(f'type_pos({str_types}, {i}, {x}).')
-            encoding.extend(type_encoding)
+            encoding.extend(sorted(type_encoding))
 
         for pred, xs in self.settings.directions.items():
             for i, v in xs.items():
@@ -92,25 +98,38 @@ class Generator:
         if settings.max_literals < max_size:
             encoding.append(f'custom_max_size({settings.max_literals}).')
 
-        if settings.noisy:
-            encoding.append(NOISY_ENCODING)
-
+        if settings.symmetry_breaking:
+            bkcons = symmetry_breaking_bkcons(bkcons)
         encoding.extend(bkcons)
 
-        if settings.single_solve:
-            encoding.append(DEFAULT_HEURISTIC)
+        if settings.coverage_heuristic:
+            encoding.append(COVERAGE_HEURISTIC)
+
+        if settings.symmetry_breaking:
+            encoding.append(SYMMETRY_BREAKING)
 
         encoding = '\n'.join(encoding)
 
         # with open('ENCODING-GEN.pl', 'w') as f:
             # f.write(encoding)
 
+        # we solve one size (layer) at a time, which gives the loop the programs in order of size, even with many threads
+        # we only ground the size constraint of a layer when we reach it, so we do not pay for the sizes that we never explore
+        self.max_size = min(max_size, settings.max_literals)
+        self.layer = 2
+        self.grounded_layer = None
+
         if self.settings.single_solve:
-            solver = clingo.Control(['--heuristic=Domain','-Wnone'])
+            args = ['--heuristic=Domain','-Wnone']
+            if settings.threads > 1:
+                args.append(f'--parallel-mode={settings.threads}')
+            solver = clingo.Control(args)
 
         solver.configuration.solve.models = 0
-        solver.add('base', [], encoding)
-        solver.ground([('base', [])])
+        ground_base(settings, solver, encoding)
+        self.literal_table = body_literal_table(solver)
+        self.atom_literals = AtomLiterals(solver, NOGOOD_SIGNATURES)
+        solver.add('size', ['n'], SIZE_ENCODING)
         self.solver = solver
 
     def update_solver(self, size):
@@ -118,40 +137,162 @@ class Generator:
         pass
 
     def get_prog(self):
-        if self.handle is None:
-            self.handle = iter(self.solver.solve(yield_ = True))
-        self.model = next(self.handle, None)
-        if self.model is None:
-            return None
+        if self.pending_rules:
+            self.restart_solve()
+        while True:
+            if self.handle is None:
+                self.start_solve()
+            self.model = next(self.handle, None)
+            if self.model is not None:
+                break
+            if not self.next_layer():
+                return None
 
         atoms = self.model.symbols(shown = True)
+        prog = self.parse_model_single_rule(atoms)
+        for rule in prog:
+            self.solve_models.append(rule.body)
+        return prog
+
+    # returns up to k programs of the same size
+    def get_progs(self, k):
+        progs = []
+        if self.stash is not None:
+            progs.append(self.stash)
+            self.stash = None
+        while len(progs) < k:
+            prog = self.get_prog()
+            if prog is None:
+                break
+            if progs and calc_prog_size(prog) != calc_prog_size(progs[0]):
+                self.stash = prog
+                break
+            progs.append(prog)
+        return progs
+
+    # whether the constraints prune the program, so that the loop can skip programs generated before the constraints were added
+    def pruned_by(self, prog, cons):
+        size = calc_prog_size(prog)
+        if size in self.pruned_sizes:
+            return True
+        head, body = tuple(prog)[0]
+        head_arity = len(head.arguments)
+        for xs in cons:
+            con_type = xs[0]
+            con_prog = xs[1]
+            if self.settings.noisy and len(xs) > 2 and xs[2] and size < xs[2]:
+                continue
+            if con_type == Constraint.SPECIALISATION:
+                _, con_body = tuple(con_prog)[0]
+                if embeds(con_body, body, head_arity):
+                    return True
+            elif con_type == Constraint.GENERALISATION or con_type == Constraint.BANISH:
+                _, con_body = tuple(con_prog)[0]
+                if is_variant(con_body, body, head_arity):
+                    return True
+            # with types, the unsat constraints exclude some bindings, so we only check the untyped case
+            elif con_type == Constraint.UNSAT and len(self.settings.body_types) == 0:
+                if embeds(con_prog, body, 0):
+                    return True
+        return False
+
+    def record_coverage(self, prog, coverage):
+        if self.coverage is not None:
+            self.coverage.record(prog, coverage)
+
+    def start_solve(self):
+        if self.grounded_layer != self.layer:
+            self.ground_layer()
+        if self.coverage is not None:
+            self.coverage.update(self.solver)
+        self.solve_handle = self.solver.solve(yield_ = True)
+        self.handle = iter(self.solve_handle)
+
+    # the size atoms are externals, so the constraints that mention them do not need to be ground again for each layer
+    def ground_layer(self):
+        solver = self.solver
+        old_layer = self.grounded_layer
+        if old_layer is not None:
+            solver.release_external(atom_to_symbol('size_in_literals', (old_layer,)))
+            solver.release_external(atom_to_symbol('size', (old_layer,)))
+            solver.release_external(atom_to_symbol('body_size', (0, old_layer-1)))
+        layer = self.layer
+        solver.ground([('size', [Number(layer)])])
+        solver.assign_external(atom_to_symbol('size_in_literals', (layer,)), True)
+        solver.assign_external(atom_to_symbol('size', (layer,)), True)
+        solver.assign_external(atom_to_symbol('body_size', (0, layer-1)), True)
+        start = 0 if old_layer is None else old_layer+1
+        for size in range(start, layer+1):
+            solver.assign_external(atom_to_symbol('program_size_at_least', (size,)), True)
+        self.grounded_layer = layer
+
+    def stop_solve(self, keep_models):
+        if self.solve_handle is not None:
+            self.solve_handle.cancel()
+            self.solve_handle.get()
+        self.solve_handle = None
+        self.handle = None
 
-        return self.parse_model_single_rule(atoms)
+        # nogoods added through the model context only last for the current solve call, so we add them as rules
+        with self.solver.backend() as backend:
+            for nogood in self.solve_nogoods:
+                backend.add_rule([], nogood)
+            # do not generate the same programs again
+            if keep_models:
+                atom_literals = self.atom_literals
+                for body in self.solve_models:
+                    nogood = [atom_literals[('body_literal', (0, pred, len(args), args))] for pred, args in body]
+                    nogood.append(atom_literals[('body_size', (0, len(body)))])
+                    backend.add_rule([], nogood)
+        self.solve_nogoods = []
+        self.solve_models = []
+
+    def restart_solve(self):
+        # clingo cannot ground whilst solving, so we stop the current solve call, ground the pending constraints, and start a new solve call
+        self.stop_solve(keep_models=True)
+        part = f'cons{self.num_parts}'
+        self.num_parts += 1
+        self.solver.add(part, [], '\n'.join(self.pending_rules))
+        self.solver.ground([(part, [])])
+        self.pending_rules = []
+
+    def next_layer(self):
+        # the models of one layer all have the same size, so we do not need to keep them
+        self.stop_solve(keep_models=False)
+        layer = self.layer + 1
+        while layer in self.pruned_sizes:
+            layer += 1
+        if layer > self.max_size:
+            return False
+        self.layer = layer
+        return True
+
+    def add_nogood(self, nogood):
+        # if the solve call has finished (such as at the end of a batch) we only keep the nogood
+        if self.model is not None:
+            self.model.context.add_nogood(nogood)
+        self.solve_nogoods.append(nogood)
 
 
     def parse_model_single_rule(self, model):
-        settings = self.settings
-        head = settings.head_literal
-        body = set()
-        cached_literals = settings.cached_literals
-        for atom in model:
-            args = atom.arguments
-            predicate = args[1].name
-            atom_args = tuple(args[3].arguments)
-            literal = cached_literals[(predicate, atom_args)]
-            body.add(literal)
-        rule = head, frozenset(body)
-        return frozenset([rule])
+        table = self.literal_table
+        body = frozenset(table[atom][1] for atom in model)
+        rule = Rule(self.settings.head_literal, body)
+        return Program([rule])
 
     def prune_size(self, size):
         if size in self.pruned_sizes:
             return
         self.pruned_sizes.add(size)
-        size_con = [(atom_to_symbol("size", (size,)), True)]
-        self.model.context.add_nogood(size_con)
+        literal = self.atom_literals[('size', (size,))]
+        if literal is not None:
+            self.add_nogood([literal])
 
     def constrain(self, tmp_new_cons):
-        new_ground_cons = set()
+        if self.stash is not None and self.pruned_by(self.stash, tmp_new_cons):
+            self.stash = None
+
+        new_ground_cons = {}
 
         for xs in tmp_new_cons:
             con_type = xs[0]
@@ -162,38 +303,43 @@ class Generator:
                 if self.settings.noisy and len(xs)>2:
                     con_size = xs[2]
                 ground_rules2 = tuple(self.build_generalisation_constraint3(con_prog, con_size))
-                new_ground_cons.update(ground_rules2)
+                new_ground_cons.update((x, con_type) for x in ground_rules2)
             elif con_type == Constraint.SPECIALISATION:
                 con_size = None
                 if self.settings.noisy and len(xs)>2:
                     con_size = xs[2]
                 ground_rules2 = tuple(self.build_specialisation_constraint3(con_prog, con_size))
-                new_ground_cons.update(ground_rules2)
+                new_ground_cons.update((x, con_type) for x in ground_rules2)
             elif con_type == Constraint.UNSAT:
                 cons_ = self.unsat_constraint2(con_prog)
-                new_ground_cons.update(cons_)
-
-        tmp = self.model.context.add_nogood
-        cached_clingo_atoms = self.cached_clingo_atoms
-
-        for ground_body in new_ground_cons:
-            nogood = []
-            for sign, pred, args in ground_body:
-                k = hash((sign, pred, args))
-                try:
-                    x = cached_clingo_atoms[k]
-                except KeyError:
-                    x = (atom_to_symbol(pred, args), sign)
-                    cached_clingo_atoms[k] = x
-                nogood.append(x)
-            tmp(nogood)
+                new_ground_cons.update((x, con_type) for x in cons_)
+
+        tmp = self.add_nogood
+        to_nogood = self.atom_literals.nogood
+        add_to_store = self.nogood_store.add
+
+        # smallest first so that a nogood is not added before one that subsumes it
+        for ground_body, con_type in sorted(new_ground_cons.items(), key=lambda x: len(x[0])):
+            if not add_to_store(ground_body, con_type):
+                continue
+            nogood = to_nogood(ground_body)
+            if nogood is not None:
+                tmp(nogood)
 
     def unsat_constraint2(self, body):
         # if no types, remap variables
         if len(self.settings.body_types) == 0:
             _, body = remap_variables((None, body))
 
-        assignments = self.find_deep_bindings4(body)
+        num_vars = len({var for atom in body for var in atom.arguments})
+        if perm(self.settings.max_vars, num_vars) > MAX_GROUND_VARIANTS:
+            bad_type_matching = ()
+            if len(self.settings.body_types) > 0 and self.settings.head_types is not None:
+                bad_type_matching = self.find_bad_type_matching(body)
+            self.pending_rules.append(nonground_constraint(body, 0, 0, self.settings.max_vars, bad_type_matching))
+            return
+
+        assignments = find_deep_bindings(body, self.settings)
         for assignment in assignments:
             rule = []
             for pred, args in body:
@@ -204,6 +350,16 @@ class Generator:
 
     def build_generalisation_constraint3(self, prog, size=None):
         rule = tuple(prog)[0]
+        head, body = rule
+        head_arity = len(head.arguments)
+        num_vars = len(frozenset(x for literal in body for x in literal.arguments) | set(head.arguments))
+        if factorial(num_vars - head_arity) > MAX_GROUND_VARIANTS:
+            extra = [f'body_size(0,{len(body)})']
+            if size:
+                extra.append(f'program_size_at_least({size})')
+            self.pending_rules.append(nonground_constraint(body, head_arity, head_arity, num_vars, extra=extra))
+            return
+
         for body in self.find_variants(rule, max_rule_vars=True):
             body = list(body)
             body.append((True, 'body_size', (0, len(body))))
@@ -213,6 +369,16 @@ class Generator:
 
     def build_specialisation_constraint3(self, prog, size=None):
         rule = tuple(prog)[0]
+        head, body = rule
+        head_arity = len(head.arguments)
+        num_body_vars = len(frozenset(x for literal in body for x in literal.arguments if x >= head_arity))
+        if perm(self.settings.max_vars - head_arity, num_body_vars) > MAX_GROUND_VARIANTS:
+            extra = []
+            if size:
+                extra.append(f'program_size_at_least({size})')
+            self.pending_rules.append(nonground_constraint(body, head_arity, head_arity, self.settings.max_vars, extra=extra))
+            return
+
         if not size:
             yield from self.find_variants(rule)
             return
@@ -229,68 +395,54 @@ class Generator:
             subset = range(len(head.arguments), len(body_vars | set(head.arguments)))
         else:
             subset = range(len(head.arguments), self.settings.max_vars)
-        for xs in permutations(subset, len(body_vars)):
-            xs = head.arguments + xs
+        for assignment in typed_bindings(sorted(body_vars), subset):
             new_body = []
             for pred, args in body:
-                new_args = tuple(xs[arg] for arg in args)
+                new_args = tuple(assignment.get(arg, arg) for arg in args)
                 new_literal = (True, 'body_literal', (0, pred, len(new_args), new_args))
                 new_body.append(new_literal)
             yield frozenset(new_body)
 
-    def find_deep_bindings4(self, body):
-        head_types = self.settings.head_types
-        body_types = self.settings.body_types
-
-        # if no types, find all permutations of variables
-        if len(body_types) == 0 or head_types is None:
-            num_vars = len({var for atom in body for var in atom.arguments})
-            for xs in permutations(range(self.settings.max_vars), num_vars):
-                x = {i:xs[i] for i in range(num_vars)}
-                yield x
-            return
-
-        # if there are types, only find type-safe permutations
-        var_type_lookup = {i:head_type for i, head_type in enumerate(head_types)}
-
-        head_vars = set(range(len(self.settings.head_literal.arguments)))
-        body_vars = set()
-
-        for pred, args in body:
-            for i, x in enumerate(args):
-                body_vars.add(x)
-                if x in head_vars:
-                    continue
-                if pred in body_types:
-                    var_type_lookup[x] = body_types[pred][i]
-
-        # prohibit bad type matchings
+    # pairs (x, y) such that the body variable x cannot be the head variable y because their types differ
+    def find_bad_type_matching(self, body):
+        var_types = body_var_types(body, self.settings.body_types)
         bad_type_matching = set()
-        for x in body_vars:
-            if x not in var_type_lookup:
-                continue
-            for y in head_vars:
-                if y not in var_type_lookup:
-                    continue
-                if var_type_lookup[x] == var_type_lookup[y]:
-                    continue
-                k = (x, y)
-                bad_type_matching.add(k)
-
-        lookup = {x:i for i, x in enumerate(body_vars)}
-
-        for xs in permutations(range(self.settings.max_vars), len(lookup)):
-            assignment = {}
-            bad = False
-            for x in body_vars:
-                v = xs[lookup[x]]
-                if (x, v) in bad_type_matching:
-                    bad = True
-                    break
-                assignment[x] = v
-            if bad:
-                continue
-            yield assignment
+        for x, t in var_types.items():
+            for y, head_type in self.settings.head_var_types.items():
+                if t != head_type:
+                    bad_type_matching.add((x, y))
+        return bad_type_matching
+
+# builds a constraint that prunes every variant of body in one non-ground rule
+# variables below head_arity are fixed, the others take distinct values in range(lower, upper)
+def nonground_constraint(body, head_arity, lower, upper, bad_type_matching=(), extra=()):
+    def var_str(x):
+        if x < head_arity:
+            return str(x)
+        return f'V{x}'
+
+    literals = []
+    body_vars = set()
+    for pred, args in body:
+        xs = [var_str(x) for x in args]
+        if len(xs) == 1:
+            xs.append('')
+        literals.append(f'body_literal(0,{pred},{len(args)},({",".join(xs)}))')
+        body_vars.update(x for x in args if x >= head_arity)
+    literals.extend(extra)
+
+    body_vars = sorted(body_vars)
+    for i, x in enumerate(body_vars):
+        if lower > 0:
+            literals.append(f'V{x}>={lower}')
+        literals.append(f'V{x}<{upper}')
+        for y in body_vars[i+1:]:
+            literals.append(f'V{x}!=V{y}')
+    for x, y in sorted(bad_type_matching):
+        if x >= head_arity:
+            literals.append(f'V{x}!={y}')
+
+    return ':- ' + ', '.join(literals) + '.'
 
 def remap_variables(rule):
     head, body = rule
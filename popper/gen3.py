@@ -9,7 +9,7 @@ import numbers
 import clingo.script
 import pkg_resources
 from collections import defaultdict
-from . util import rule_is_recursive, Constraint, bias_order, Literal
+from . util import rule_is_recursive, Constraint, bias_order, Literal, Rule, Program, ground_base, vars_encoding, NogoodStore, CoverageHeuristic, COVERAGE_HEURISTIC, SYMMETRY_BREAKING, symmetry_breaking_bkcons, body_literal_table, AtomLiterals, NOGOOD_SIGNATURES, typed_bindings, find_deep_bindings
 clingo.script.enable_python()
 from clingo import Function, Number, Tuple_
 from itertools import permutations
@@ -36,8 +36,8 @@ class Generator:
         self.settings = settings
         self.seen_handles = set()
         self.assigned = {}
-        self.seen_symbols = {}
-        self.cached_clingo_atoms = {}
+        self.nogood_store = NogoodStore(settings.stats)
+        self.coverage = CoverageHeuristic() if settings.coverage_heuristic else None
         self.handle = None
         self.cached_handles = {}
         self.cached4 = {}
@@ -72,12 +72,7 @@ class Generator:
         encoding.append(f'head_vars({head_arity}, {tuple(range(head_arity))}).')
         arities = set(a for p, a in self.settings.body_preds)
         arities.add(head_arity)
-        for arity in arities:
-            for xs in permutations(range(settings.max_vars), arity):
-                encoding.append(f'vars({arity}, {tuple(xs)}).')
-
-                for i, x in enumerate(xs):
-                    encoding.append(f'var_pos({x}, {tuple(xs)}, {i}).')
+        encoding.append(vars_encoding(arities))
 
         # types = tuple(self.settings.head_types)
         # str_types = str(types).replace("'","")
@@ -111,6 +106,8 @@ class Generator:
             program_size_at_least(M):- size(N), program_bounds(M), M <= N.
             """)
 
+        if settings.symmetry_breaking:
+            bkcons = symmetry_breaking_bkcons(bkcons)
         # if settings.bkcons:
         encoding.extend(bkcons)
 
@@ -118,15 +115,25 @@ class Generator:
             if settings.order_space:
                 encoding.append(DEFAULT_HEURISTIC)
 
+        if settings.coverage_heuristic:
+            encoding.append(COVERAGE_HEURISTIC)
+
+        if settings.symmetry_breaking:
+            encoding.append(SYMMETRY_BREAKING)
+
         encoding = '\n'.join(encoding)
 
         # with open('ENCODING-GEN.pl', 'w') as f:
             # f.write(encoding)
 
-        if self.settings.single_solve:
-            solver = clingo.Control(['--heuristic=Domain','-Wnone'])
-        else:
-            solver = clingo.Control(['-Wnone'])
+        args = ['-Wnone']
+        if self.settings.single_solve or settings.coverage_heuristic:
+            args.append('--heuristic=Domain')
+        if settings.threads > 1:
+            args.append(f'--parallel-mode={settings.threads}')
+        solver = clingo.Control(args)
+
+        if not self.settings.single_solve:
             NUM_OF_LITERALS = """
             %%% External atom for number of literals in the program %%%%%
             #external size_in_literals(n).
@@ -137,8 +144,9 @@ class Generator:
             solver.add('number_of_literals', ['n'], NUM_OF_LITERALS)
 
         solver.configuration.solve.models = 0
-        solver.add('base', [], encoding)
-        solver.ground([('base', [])])
+        ground_base(settings, solver, encoding)
+        self.literal_table = body_literal_table(solver)
+        self.atom_literals = AtomLiterals(solver, NOGOOD_SIGNATURES)
         self.solver = solver
 
     def get_prog(self):
@@ -158,53 +166,45 @@ class Generator:
         return self.parse_model_recursion(atoms)
 
     def gen_symbol(self, literal, backend):
-        sign, pred, args = literal
-        k = hash(literal)
-        if k in self.seen_symbols:
-            symbol = self.seen_symbols[k]
-        else:
-            symbol = backend.add_atom(atom_to_symbol(pred, args))
-            self.seen_symbols[k] = symbol
+        _sign, pred, args = literal
+        k = (pred, args)
+        symbol = self.atom_literals[k]
+        if symbol is None:
+            symbol = self.atom_literals[k] = backend.add_atom(atom_to_symbol(pred, args))
         return symbol
 
     def parse_model_recursion(self, model):
         settings = self.settings
         rule_index_to_body = defaultdict(set)
         head = settings.head_literal
-        cached_literals = settings.cached_literals
+        table = self.literal_table
 
         for atom in model:
-            args = atom.arguments
-            rule_index = args[0].number
-            predicate = args[1].name
-            atom_args = tuple(args[3].arguments)
-            literal = cached_literals[(predicate, atom_args)]
+            rule_index, literal = table[atom]
             rule_index_to_body[rule_index].add(literal)
 
         prog = []
         for rule_index, body in rule_index_to_body.items():
             body = frozenset(body)
-            rule = head, body
+            rule = Rule(head, body)
             prog.append((rule))
 
-        return frozenset(prog)
+        return Program(prog)
 
     def parse_model_single_rule(self, model):
-        settings = self.settings
-        head = settings.head_literal
-        body = set()
-        cached_literals = settings.cached_literals
-        for atom in model:
-            args = atom.arguments
-            predicate = args[1].name
-            atom_args = tuple(args[3].arguments)
-            literal = cached_literals[(predicate, atom_args)]
-            body.add(literal)
-        rule = head, frozenset(body)
-        return frozenset([rule])
+        table = self.literal_table
+        body = frozenset(table[atom][1] for atom in model)
+        rule = Rule(self.settings.head_literal, body)
+        return Program([rule])
+
+    def record_coverage(self, prog, coverage):
+        if self.coverage is not None:
+            self.coverage.record(prog, coverage)
 
     def update_solver(self, size):
         self.update_number_of_literals(size)
+        if self.coverage is not None:
+            self.coverage.update(self.solver)
 
         # rules to add via Clingo's backend interface
         to_add = []
@@ -290,11 +290,12 @@ class Generator:
         if size in self.pruned_sizes:
             return
         self.pruned_sizes.add(size)
-        size_con = [(atom_to_symbol("size", (size,)), True)]
-        self.model.context.add_nogood(size_con)
+        literal = self.atom_literals[('size', (size,))]
+        if literal is not None:
+            self.model.context.add_nogood([literal])
 
     def constrain(self, tmp_new_cons):
-        new_cons = set()
+        new_cons = {}
 
         for xs in tmp_new_cons:
             con_type = xs[0]
@@ -305,46 +306,46 @@ class Generator:
                 if self.settings.noisy and len(xs)>2:
                     con_size = xs[2]
                 xs = set(self.build_generalisation_constraint3(con_prog, con_size))
-                new_cons.update(xs)
+                new_cons.update((x, con_type) for x in xs)
             elif con_type == Constraint.SPECIALISATION:
                 con_size = None
                 if self.settings.noisy and len(xs)>2:
                     con_size = xs[2]
                 xs = set(self.build_specialisation_constraint3(con_prog, con_size))
-                new_cons.update(xs)
+                new_cons.update((x, con_type) for x in xs)
             elif con_type == Constraint.UNSAT:
-                new_cons.update(self.unsat_constraint2(con_prog))
+                new_cons.update((x, con_type) for x in self.unsat_constraint2(con_prog))
             elif con_type == Constraint.REDUNDANCY_CONSTRAINT1:
                 xs = set(self.redundancy_constraint1(con_prog))
-                new_cons.update(xs)
+                new_cons.update((x, con_type) for x in xs)
             elif con_type == Constraint.REDUNDANCY_CONSTRAINT2:
                 if len(con_prog) == 1:
                     xs = set(self.redundancy_constraint1(con_prog))
                 else:
                     xs = set(self.build_specialisation_constraint3(con_prog))
-                new_cons.update(xs)
+                new_cons.update((x, con_type) for x in xs)
             elif con_type == Constraint.TMP_ANDY:
                 assert(False)
             elif con_type == Constraint.BANISH:
                 xs = set(self.build_banish_constraint(con_prog))
-                new_cons.update(xs)
+                new_cons.update((x, con_type) for x in xs)
 
         tmp = self.model.context.add_nogood
+        to_nogood = self.atom_literals.nogood
+        added = set()
 
-        for ground_body in new_cons:
-            nogood = []
-            for sign, pred, args in ground_body:
-                k = hash((sign, pred, args))
-                try:
-                    x = self.cached_clingo_atoms[k]
-                except KeyError:
-                    x = (atom_to_symbol(pred, args), sign)
-                    self.cached_clingo_atoms[k] = x
-                nogood.append(x)
+        # smallest first so that a nogood is not added before one that subsumes it
+        for ground_body, con_type in sorted(new_cons.items(), key=lambda x: len(x[0])):
+            if not self.nogood_store.add(ground_body, con_type):
+                continue
+            added.add(ground_body)
+            nogood = to_nogood(ground_body)
+            if nogood is None:
+                continue
             tmp(nogood)
 
         # add ground cons
-        self.new_ground_cons.update(new_cons)
+        self.new_ground_cons.update(added)
 
     def make_rule_handle(self, rule):
         cached_handles = self.cached_handles
@@ -557,11 +558,10 @@ class Generator:
         else:
             subset = range(len(head.arguments), self.settings.max_vars)
         subset = range(head_arity, self.settings.max_vars)
-        for xs in permutations(subset, len(body_vars)):
-            xs = head.arguments + xs
+        for assignment in typed_bindings(sorted(body_vars), subset):
             new_body = []
             for pred, args in body:
-                new_args = tuple(xs[arg] for arg in args)
+                new_args = tuple(assignment.get(arg, arg) for arg in args)
                 new_literal = (True, 'body_literal', (ruleid, pred, len(new_args), new_args))
                 new_body.append(new_literal)
             yield frozenset(new_body)
@@ -631,7 +631,7 @@ class Generator:
         if len(self.settings.body_types) == 0:
             _, body = remap_variables((None, body))
 
-        assignments = self.find_deep_bindings4(body)
+        assignments = find_deep_bindings(body, self.settings)
         for rule_id in range(self.settings.max_rules):
             for assignment in assignments:
                 rule = []
@@ -640,60 +640,6 @@ class Generator:
                     rule.append((True, 'body_literal', (rule_id, pred, len(args), args2)))
                 yield frozenset(rule)
 
-    def find_deep_bindings4(self, body):
-        head_types = self.settings.head_types
-        body_types = self.settings.body_types
-
-        # if no types, find all permutations of variables
-        if len(body_types) == 0 or head_types is None:
-            num_vars = len({var for atom in body for var in atom.arguments})
-            for xs in permutations(range(self.settings.max_vars), num_vars):
-                x = {i:xs[i] for i in range(num_vars)}
-                yield x
-            return
-
-        # if there are types, only find type-safe permutations
-        var_type_lookup = {i:head_type for i, head_type in enumerate(head_types)}
-
-        head_vars = set(range(len(self.settings.head_literal.arguments)))
-        body_vars = set()
-
-        for pred, args in body:
-            for i, x in enumerate(args):
-                body_vars.add(x)
-                if x in head_vars:
-                    continue
-                if pred in body_types:
-                    var_type_lookup[x] = body_types[pred][i]
-
-        # prohibit bad type matchings
-        bad_type_matching = set()
-        for x in body_vars:
-            if x not in var_type_lookup:
-                continue
-            for y in head_vars:
-                if y not in var_type_lookup:
-                    continue
-                if var_type_lookup[x] == var_type_lookup[y]:
-                    continue
-                k = (x, y)
-                bad_type_matching.add(k)
-
-        lookup = {x:i for i, x in enumerate(body_vars)}
-
-        for xs in permutations(range(self.settings.max_vars), len(lookup)):
-            assignment = {}
-            bad = False
-            for x in body_vars:
-                v = xs[lookup[x]]
-                if (x, v) in bad_type_matching:
-                    bad = True
-                    break
-                assignment[x] = v
-            if bad:
-                continue
-            yield assignment
-
 def remap_variables(rule):
     head, body = rule
     head_vars = set()
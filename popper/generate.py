@@ -9,10 +9,10 @@ import numbers
 import clingo.script
 import pkg_resources
 from collections import defaultdict
-from . util import rule_is_recursive, Constraint, bias_order, Literal, format_rule, remap_variables
+from . util import rule_is_recursive, Constraint, bias_order, Literal, format_rule, remap_variables, Rule, Program, ground_base, vars_encoding, NogoodStore, CoverageHeuristic, COVERAGE_HEURISTIC, SYMMETRY_BREAKING, symmetry_breaking_bkcons, body_literal_table, AtomLiterals, NOGOOD_SIGNATURES, find_deep_bindings
 clingo.script.enable_python()
 from clingo import Function, Number, Tuple_
-from itertools import permutations
+from itertools import permutations, product
 import dataclasses
 
 @dataclasses.dataclass(frozen=True)
@@ -54,9 +54,10 @@ def find_all_vars(body):
     return all_vars
 
 # AC: When grounding constraint rules, we only care about the vars and the constraints, not the actual literals
-def grounding_hash(body, all_vars):
+# we key on the structure itself rather than its hash so that two shapes can never share an entry
+def grounding_key(body, all_vars):
     cons = frozenset((lit.predicate, lit.arguments) for lit in body if lit.predicate in META_PREDS)
-    return hash((frozenset(all_vars), cons))
+    return frozenset(all_vars), cons
 
 def build_seen_rule_literal(handle, rule_var):
     return Literal('seen_rule', (handle, rule_var))
@@ -82,8 +83,8 @@ class Generator:
         self.settings = settings
         self.seen_handles = set()
         self.assigned = {}
-        self.seen_symbols = {}
-        self.cached_clingo_atoms = {}
+        self.nogood_store = NogoodStore(settings.stats)
+        self.coverage = CoverageHeuristic() if settings.coverage_heuristic else None
         self.handle = None
         self.cached_handles = {}
         self.cached_grounded = {}
@@ -122,12 +123,7 @@ class Generator:
         encoding.append(f'head_vars({head_arity}, {tuple(range(head_arity))}).')
         arities = set(a for p, a in self.settings.body_preds)
         arities.add(head_arity)
-        for arity in arities:
-            for xs in permutations(range(settings.max_vars), arity):
-                encoding.append(f'vars({arity}, {tuple(xs)}).')
-
-                for i, x in enumerate(xs):
-                    encoding.append(f'var_pos({x}, {tuple(xs)}, {i}).')
+        encoding.append(vars_encoding(arities))
 
         # types = tuple(self.settings.head_types)
         # str_types = str(types).replace("'","")
@@ -161,6 +157,8 @@ class Generator:
             program_size_at_least(M):- size(N), program_bounds(M), M <= N.
             """)
 
+        if settings.symmetry_breaking:
+            bkcons = symmetry_breaking_bkcons(bkcons)
         # if settings.bkcons:
         encoding.extend(bkcons)
 
@@ -197,15 +195,25 @@ class Generator:
                 """
                 encoding.append(DEFAULT_HEURISTIC)
 
+        if settings.coverage_heuristic:
+            encoding.append(COVERAGE_HEURISTIC)
+
+        if settings.symmetry_breaking:
+            encoding.append(SYMMETRY_BREAKING)
+
         encoding = '\n'.join(encoding)
 
         # with open('ENCODING-GEN.pl', 'w') as f:
             # f.write(encoding)
 
-        if self.settings.single_solve:
-            solver = clingo.Control(['--heuristic=Domain','-Wnone'])
-        else:
-            solver = clingo.Control(['-Wnone'])
+        args = ['-Wnone']
+        if self.settings.single_solve or settings.coverage_heuristic:
+            args.append('--heuristic=Domain')
+        if settings.threads > 1:
+            args.append(f'--parallel-mode={settings.threads}')
+        solver = clingo.Control(args)
+
+        if not self.settings.single_solve:
             NUM_OF_LITERALS = """
             %%% External atom for number of literals in the program %%%%%
             #external size_in_literals(n).
@@ -237,8 +245,9 @@ class Generator:
 
 
         solver.configuration.solve.models = 0
-        solver.add('base', [], encoding)
-        solver.ground([('base', [])])
+        ground_base(settings, solver, encoding)
+        self.literal_table = body_literal_table(solver)
+        self.atom_literals = AtomLiterals(solver, NOGOOD_SIGNATURES)
         self.solver = solver
 
     # @profile
@@ -259,50 +268,36 @@ class Generator:
         return self.parse_model_recursion(atoms)
 
     def gen_symbol(self, literal, backend):
-        sign, pred, args = literal
-        k = hash(literal)
-        if k in self.seen_symbols:
-            symbol = self.seen_symbols[k]
-        else:
-            symbol = backend.add_atom(atom_to_symbol(pred, args))
-            self.seen_symbols[k] = symbol
+        _sign, pred, args = literal
+        k = (pred, args)
+        symbol = self.atom_literals[k]
+        if symbol is None:
+            symbol = self.atom_literals[k] = backend.add_atom(atom_to_symbol(pred, args))
         return symbol
 
     def parse_model_recursion(self, model):
         settings = self.settings
         rule_index_to_body = defaultdict(set)
         head = settings.head_literal
-        cached_literals = settings.cached_literals
+        table = self.literal_table
 
         for atom in model:
-            args = atom.arguments
-            rule_index = args[0].number
-            predicate = args[1].name
-            atom_args = tuple(args[3].arguments)
-            literal = cached_literals[(predicate, atom_args)]
+            rule_index, literal = table[atom]
             rule_index_to_body[rule_index].add(literal)
 
         prog = []
         for rule_index, body in rule_index_to_body.items():
             body = frozenset(body)
-            rule = head, body
+            rule = Rule(head, body)
             prog.append((rule))
 
-        return frozenset(prog)
+        return Program(prog)
 
     def parse_model_single_rule(self, model):
-        settings = self.settings
-        head = settings.head_literal
-        body = set()
-        cached_literals = settings.cached_literals
-        for atom in model:
-            args = atom.arguments
-            predicate = args[1].name
-            atom_args = tuple(args[3].arguments)
-            literal = cached_literals[(predicate, atom_args)]
-            body.add(literal)
-        rule = head, frozenset(body)
-        return frozenset([rule])
+        table = self.literal_table
+        body = frozenset(table[atom][1] for atom in model)
+        rule = Rule(self.settings.head_literal, body)
+        return Program([rule])
 
     def parse_model_pi(self, model):
         settings = self.settings
@@ -356,13 +351,19 @@ class Generator:
             for (body_pred, body_args, body_arity) in rule_index_to_body[rule_index]:
                 body.add(Literal(body_pred, body_args))
             body = frozenset(body)
-            rule = head, body
+            rule = Rule(head, body)
             prog.append((rule))
 
-        return frozenset(prog)
+        return Program(prog)
+
+    def record_coverage(self, prog, coverage):
+        if self.coverage is not None:
+            self.coverage.record(prog, coverage)
 
     def update_solver(self, size):
         self.update_number_of_literals(size)
+        if self.coverage is not None:
+            self.coverage.update(self.solver)
         # self.update_number_of_vars(num_vars)
         # self.update_number_of_rules(num_rules)
 
@@ -499,9 +500,9 @@ class Generator:
         self.solver.assign_external(symbol, True)
 
     def prune_size(self, size):
-        size_con = [(atom_to_symbol("size", (size,)), True)]
-        # print('moo', size)
-        self.model.context.add_nogood(size_con)
+        literal = self.atom_literals[('size', (size,))]
+        if literal is not None:
+            self.model.context.add_nogood([literal])
 
     # @profile
     def get_ground_rules(self, rule):
@@ -530,7 +531,7 @@ class Generator:
     # @profile
     def constrain(self, tmp_new_cons):
         model = self.model
-        new_cons = set()
+        new_cons = {}
         debug = True
         # debug = False
 
@@ -555,7 +556,7 @@ class Generator:
                     con_size = xs[2]
                 new_rule_handles2, con = self.build_generalisation_constraint2(con_prog, gen_size=con_size)
                 self.all_handles.update(new_rule_handles2)
-                new_cons.add(con)
+                new_cons[con] = con_type
             elif con_type == Constraint.SPECIALISATION:
                 # con_size = xs[2]
                 con_size = None
@@ -563,7 +564,7 @@ class Generator:
                     con_size = xs[2]
                 new_rule_handles2, con = self.build_specialisation_constraint2(con_prog, spec_size=con_size)
                 self.all_handles.update(new_rule_handles2)
-                new_cons.add(con)
+                new_cons[con] = con_type
             elif con_type == Constraint.UNSAT:
                 cons_ = self.unsat_constraint2(con_prog)
                 self.new_ground_cons.update(cons_)
@@ -571,42 +572,36 @@ class Generator:
                 bad_handle, new_rule_handles2, con = self.redundancy_constraint1(con_prog)
                 self.bad_handles.add(bad_handle)
                 self.all_handles.update(new_rule_handles2)
-                new_cons.add(con)
+                new_cons[con] = con_type
             elif con_type == Constraint.REDUNDANCY_CONSTRAINT2:
                 new_rule_handles2, cons = self.redundancy_constraint2(con_prog)
                 self.all_handles.update(new_rule_handles2)
-                new_cons.update(cons)
+                new_cons.update((con, con_type) for con in cons)
             elif con_type == Constraint.TMP_ANDY:
-                new_cons.update(self.andy_tmp_con(con_prog))
+                new_cons.update((con, con_type) for con in self.andy_tmp_con(con_prog))
             elif con_type == Constraint.BANISH:
                 new_rule_handles2, con = self.build_banish_constraint(con_prog)
                 self.all_handles.update(new_rule_handles2)
-                new_cons.add(con)
+                new_cons[con] = con_type
 
-        self.all_ground_cons.update(self.new_ground_cons)
-        ground_bodies = set()
-        ground_bodies.update(self.new_ground_cons)
+        ground_bodies = {x: Constraint.UNSAT for x in self.new_ground_cons}
 
-        for con in new_cons:
+        for con, con_type in new_cons.items():
             ground_rules = self.get_ground_rules((None, con))
             for ground_rule in ground_rules:
                 _ground_head, ground_body = ground_rule
-                ground_bodies.add(ground_body)
-                # if con_type == Constraint.REDUNDANCY_CONSTRAINT1:
-                # print(sorted(ground_body))
-                self.all_ground_cons.add(frozenset(ground_body))
+                ground_bodies[frozenset(ground_body)] = con_type
 
         nogoods = []
-        for ground_body in ground_bodies:
-            nogood = []
-            for sign, pred, args in ground_body:
-                k = hash((sign, pred, args))
-                try:
-                    x = self.cached_clingo_atoms[k]
-                except KeyError:
-                    x = (atom_to_symbol(pred, args), sign)
-                    self.cached_clingo_atoms[k] = x
-                nogood.append(x)
+        to_nogood = self.atom_literals.nogood
+        # smallest first so that a nogood is not added before one that subsumes it
+        for ground_body, con_type in sorted(ground_bodies.items(), key=lambda x: len(x[0])):
+            if not self.nogood_store.add(ground_body, con_type):
+                continue
+            self.all_ground_cons.add(ground_body)
+            nogood = to_nogood(ground_body)
+            if nogood is None:
+                continue
             nogoods.append(nogood)
 
         # with self.settings.stats.duration('constrain_clingo'):
@@ -929,7 +924,7 @@ class Generator:
         if len(self.settings.body_types) == 0:
             _, body = remap_variables((None, body))
 
-        assignments = self.find_deep_bindings4(body)
+        assignments = find_deep_bindings(body, self.settings)
         out = []
         # print(format_prog([(None, body)]))
         # :- empty(V3),tail(V3,V1).
@@ -985,200 +980,80 @@ class Generator:
         return ground_head, frozenset(ground_body)
 
     def find_bindings(self, body, all_vars):
-
-        k = grounding_hash(body, all_vars)
-        if k in self.seen_assignments:
+        k = grounding_key(body, all_vars)
+        try:
             return self.seen_assignments[k]
+        except KeyError:
+            pass
 
         max_rules, max_vars = self.settings.max_rules, self.settings.max_vars
 
-        # map each rule and var_var in the program to an integer
-        rule_var_to_int = {v:i for i, v in enumerate(var for var in all_vars if isinstance(var, RuleVar))}
-
-        # transpose for later lookup
-        int_to_rule_var = {i:v for v,i in rule_var_to_int.items()}
+        # we used to build a new clingo control for every new constraint shape and ask it for all its models. the constraints on the bindings are so simple (injective assignments with a few bounds) that enumerating them directly in Python is much cheaper than creating the control
 
-        # find all variables for each rule
-        rule_vars = {k:set() for k in rule_var_to_int}
+        rule_vars = [var for var in all_vars if isinstance(var, RuleVar)]
+        var_vars = {rule_var:[] for rule_var in rule_vars}
         for var in all_vars:
             if isinstance(var, VarVar):
-                rule_vars[var.rule].add(var)
+                var_vars[var.rule].append(var)
 
-        encoding = []
-        encoding.append(BINDING_ENCODING)
-        encoding.append(f'#const max_rules={max_rules}.')
-        encoding.append(f'#const max_vars={max_vars}.')
-
-        int_lookup = {}
-        tmp_lookup = {}
-        for rule_var, xs in rule_vars.items():
-            rule_var_int = rule_var_to_int[rule_var]
-            encoding.append(f'rule({rule_var_int}).')
-
-            for var_var_int, var_var in enumerate(xs):
-                encoding.append(f'rule_var({rule_var_int},{var_var_int}).')
-                int_lookup[(rule_var_int, var_var_int)] = var_var
-                tmp_lookup[(rule_var, var_var)] = var_var_int
-                # rule_var_lookup[(rule_var, i)] = var
-                # rule_var_to_int[var] = i
-
-        # rule_var_lookup[(rule_var, i)] = var
-        # rule_var_to_int[var] = i
-        # add constraints to the ASP program based on the AST thing
+        # bounds on the value of each rule var and ordering constraints between rule vars
+        lower = {rule_var:0 for rule_var in rule_vars}
+        upper = {rule_var:max_rules for rule_var in rule_vars}
+        rule_orderings = []
+        fixed = {}
         for lit in body:
             if not lit.predicate in META_PREDS:
                 continue
             if lit.predicate == '==':
-                # pass
                 var, value = lit.arguments
-                rule_var = var.rule
-                rule_var_int = rule_var_to_int[rule_var]
-                var_var_int = tmp_lookup[(rule_var, var)]
-                encoding.append(f':- not bind_var({rule_var_int},{var_var_int},{value}).')
+                fixed[var] = value
             elif lit.predicate == '>=':
                 var, val = lit.arguments
-                rule_var_int1 = rule_var_to_int[var]
-                # var = c_vars[var]
-                # for i in range(val):
-                # encoding.append(f':- c_var({var},{i}).')
-                encoding.append(f':- bind_rule({rule_var_int1},Val1), Val1 < {val}.')
+                lower[var] = max(lower[var], val)
             elif lit.predicate == '<':
                 a, b = lit.arguments
-                if isinstance(b, int):
                 # ABSOLUTE HACK
-                    rule_var_int1 = rule_var_to_int[a]
-                    encoding.append(f':- bind_rule({rule_var_int1},Val1), Val1 >= {b}.')
+                if isinstance(b, int):
+                    upper[a] = min(upper[a], b)
                 else:
-                    rule_var_int1 = rule_var_to_int[a]
-                    rule_var_int2 = rule_var_to_int[b]
-                    encoding.append(f':- bind_rule({rule_var_int1},Val1), bind_rule({rule_var_int2},Val2), Val1>=Val2.')
-
-        encoding = '\n'.join(encoding)
+                    rule_orderings.append((a, b))
 
-        # print(encoding)
-
-        # print('ASDASDA')
-        # solver = clingo.Control()
-        solver = clingo.Control(['-Wnone'])
-        # solver = clingo.Control(["-t4"])
-        # ask for all models
-        solver.configuration.solve.models = 0
-        solver.add('base', [], encoding)
-        solver.ground([("base", [])])
+        # all the ways of binding the rule vars to distinct rules
+        rule_bindings = []
+        for xs in permutations(range(max_rules), len(rule_vars)):
+            assignment = dict(zip(rule_vars, xs))
+            if any(not (lower[var] <= assignment[var] < upper[var]) for var in rule_vars):
+                continue
+            if any(assignment[a] >= assignment[b] for a, b in rule_orderings):
+                continue
+            rule_bindings.append(tuple(assignment.items()))
+
+        # for each rule, all the ways of binding its vars to distinct values
+        var_bindings = []
+        for rule_var in rule_vars:
+            xs = var_vars[rule_var]
+            fixed_vars = [var for var in xs if var in fixed]
+            free_vars = [var for var in xs if var not in fixed]
+            fixed_values = set(fixed[var] for var in fixed_vars)
+            if len(fixed_values) < len(fixed_vars) or any(not (0 <= value < max_vars) for value in fixed_values):
+                self.seen_assignments[k] = []
+                return []
+            fixed_items = tuple((var, fixed[var]) for var in fixed_vars)
+            free_values = [value for value in range(max_vars) if value not in fixed_values]
+            bindings = [fixed_items + tuple(zip(free_vars, ys)) for ys in permutations(free_values, len(free_vars))]
+            var_bindings.append(bindings)
 
         out = []
+        for rule_binding in rule_bindings:
+            for xs in product(*var_bindings):
+                assignment = dict(rule_binding)
+                for items in xs:
+                    assignment.update(items)
+                out.append(assignment)
 
-        def on_model(m):
-            xs = m.symbols(shown = True)
-            # map a variable to a program variable
-            # print('xs', xs)
-            assignment = {}
-            for x in xs:
-                name = x.name
-                args = x.arguments
-                if name == 'bind_var':
-                    rule_var_int = args[0].number
-                    var_var_int = args[1].number
-                    value = args[2].number
-                    var_var = int_lookup[(rule_var_int, var_var_int)]
-                    assignment[var_var] = value
-                else:
-                    rule_var_int = args[0].number
-                    value = args[1].number
-                    rule_var = int_to_rule_var[rule_var_int]
-                    assignment[rule_var] = value
-            out.append(assignment)
-        solver.solve(on_model=on_model)
         self.seen_assignments[k] = out
         return out
 
-    def find_deep_bindings4(self, body):
-        head_types = self.settings.head_types
-        body_types = self.settings.body_types
-
-        # if no types, find all permutations of variables
-        if len(body_types) == 0 or head_types is None:
-            num_vars = len({var for atom in body for var in atom.arguments})
-            for xs in permutations(range(self.settings.max_vars), num_vars):
-                x = {i:xs[i] for i in range(num_vars)}
-                yield x
-            return
-
-        # if there are types, only find type-safe permutations
-        var_type_lookup = {i:head_type for i, head_type in enumerate(head_types)}
-
-        head_vars = set(range(len(self.settings.head_literal.arguments)))
-        body_vars = set()
-
-        for pred, args in body:
-            for i, x in enumerate(args):
-                body_vars.add(x)
-                if x in head_vars:
-                    continue
-                if pred in body_types:
-                    var_type_lookup[x] = body_types[pred][i]
-
-        # prohibit bad type matchings
-        bad_type_matching = set()
-        for x in body_vars:
-            if x not in var_type_lookup:
-                continue
-            for y in head_vars:
-                if y not in var_type_lookup:
-                    continue
-                if var_type_lookup[x] == var_type_lookup[y]:
-                    continue
-                k = (x, y)
-                bad_type_matching.add(k)
-
-        lookup = {x:i for i, x in enumerate(body_vars)}
-
-        for xs in permutations(range(self.settings.max_vars), len(lookup)):
-            assignment = {}
-            bad = False
-            for x in body_vars:
-                v = xs[lookup[x]]
-                if (x, v) in bad_type_matching:
-                    bad = True
-                    break
-                assignment[x] = v
-            if bad:
-                continue
-            yield assignment
-
-
-BINDING_ENCODING = """\
-#defined rule_var/2.
-#show bind_rule/2.
-#show bind_var/3.
-
-% bind a rule_id to a value
-{bind_rule(Rule,Value)}:-
-    rule(Rule),
-    Value=0..max_rules-1.
-{bind_var(Rule,Var,Value)}:-
-    rule_var(Rule,Var),
-    Value=0..max_vars-1.
-
-% every rule must be bound to exactly one value
-:-
-    rule(Rule),
-    #count{Value: bind_rule(Rule,Value)} != 1.
-% for each rule, each var must be bound to exactly one value
-:-
-    rule_var(Rule,Var),
-    #count{Value: bind_var(Rule,Var,Value)} != 1.
-% a rule value cannot be bound to more than one rule
-:-
-    Value=0..max_rules-1,
-    #count{Rule : bind_rule(Rule,Value)} > 1.
-% a var value cannot be bound to more than one var per rule
-:-
-    rule(Rule),
-    Value=0..max_vars-1,
-    #count{Var : bind_var(Rule,Var,Value)} > 1.
-"""
-
 def vo_variable2(rule, variable):
     key = f'{rule.name}_V{variable}'
     return VarVar(rule=rule, name=key)
@@ -1,12 +1,13 @@
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from bitarray.util import subset, any_and, ones
 from functools import cache
-from itertools import chain, combinations, permutations
-from . util import timeout, format_rule, rule_is_recursive, prog_is_recursive, prog_has_invention, calc_prog_size, format_literal, Constraint, mdl_score, suppress_stdout_stderr, get_raw_prog, Literal, remap_variables, format_prog
+from itertools import chain, combinations
+from . util import timeout, format_rule, rule_is_recursive, prog_is_recursive, prog_has_invention, calc_prog_size, format_literal, Constraint, mdl_score, suppress_stdout_stderr, get_raw_prog, Literal, remap_variables, format_prog, head_connected, Rule, Program, body_signature, is_variant
 from . tester import Tester
 from . bkcons import deduce_bk_cons, deduce_recalls, deduce_type_cons
 from . combine import Combiner
+from . import maxsat
 
 def explain_none_functional(settings, tester, prog):
     new_cons = []
@@ -47,7 +48,7 @@ def load_solver(settings, tester, coverage_pos, coverage_neg, prog_lookup):
     if settings.debug:
         settings.logger.debug(f'Load exact solver: {settings.solver}')
 
-    if settings.solver not in ['rc2', 'uwr', 'wmaxcdcl']:
+    if settings.solver not in ['rc2', 'uwr', 'wmaxcdcl', 'portfolio']:
         print('INVALID SOLVER')
         exit()
 
@@ -57,6 +58,12 @@ def load_solver(settings, tester, coverage_pos, coverage_neg, prog_lookup):
     if settings.solver == 'rc2':
         settings.exact_maxsat_solver = 'rc2'
         settings.old_format = False
+    elif settings.solver == 'portfolio':
+        settings.exact_maxsat_solver = 'portfolio'
+        settings.maxsat_portfolio = maxsat.portfolio_members()
+        settings.old_format = False
+        if settings.debug:
+            settings.logger.debug(f'Portfolio solvers: {", ".join(name for name, _, _ in settings.maxsat_portfolio)}')
     elif settings.solver == 'uwr':
         settings.exact_maxsat_solver='uwrmaxsat'
         settings.exact_maxsat_solver_params="-v0 -no-sat -no-bin -m -bm"
@@ -76,9 +83,11 @@ def load_solver(settings, tester, coverage_pos, coverage_neg, prog_lookup):
     if settings.debug:
         settings.logger.debug(f'Load anytime solver:{settings.anytime_solver}')
 
-    if settings.anytime_solver in ['wmaxcdcl', 'nuwls']:
+    if settings.anytime_solver in ['wmaxcdcl', 'nuwls', 'lns']:
         settings.maxsat_timeout = settings.anytime_timeout
-        if settings.anytime_solver == 'wmaxcdcl':
+        if settings.anytime_solver == 'lns':
+            settings.anytime_maxsat_solver = 'lns'
+        elif settings.anytime_solver == 'wmaxcdcl':
             settings.anytime_maxsat_solver = 'wmaxcdcl'
             settings.anytime_maxsat_solver_params = ""
             settings.anytime_maxsat_solver_signal = 10
@@ -100,7 +109,11 @@ class Popper():
     def __init__(self, settings, tester):
         self.settings = settings
         self.tester = tester
-        self.pruned2 = set()
+        self.pruned2 = defaultdict(list)
+
+        # programs taken from the generator but not yet tested, and the constraints learned from the current batch
+        self.batch = deque()
+        self.batch_cons = []
 
         # AC: SELF.SEEN_PROG CAN GROW VERY BIG
         self.seen_prog = set()
@@ -197,7 +210,10 @@ class Popper():
 
                 # generate a program
                 with settings.stats.duration('generate'):
-                    prog = generator.get_prog()
+                    if settings.single_solve and settings.gen_batch_size > 1:
+                        prog = self.next_batch_prog()
+                    else:
+                        prog = generator.get_prog()
                     if prog is None:
                         break
 
@@ -260,6 +276,9 @@ class Popper():
                 tp = pos_covered.count(1)
                 fn = num_pos-tp
 
+                if settings.coverage_heuristic and not skipped and not inconsistent and tp > 0:
+                    generator.record_coverage(prog, tp/num_pos)
+
                 # print(format_prog(prog2))
                 # pos_covered, neg_covered = tester.test_prog_all(prog)
                 # if not inconsistent:
@@ -729,6 +748,24 @@ class Popper():
                             for i in range(hypothesis_size, max_size+1):
                                 generator.prune_size(i)
 
+                elif add_to_combiner and settings.solution_found and not settings.noisy and not settings.recursion_enabled and not settings.pi_enabled:
+                    # between calls to the combiner, a greedy combination of the programs may give a smaller size bound
+                    with settings.stats.duration('greedy combine'):
+                        greedy_solution = combiner.greedy_combination(to_combine)
+
+                    if greedy_solution is not None:
+                        new_hypothesis, conf_matrix = greedy_solution
+                        # not tp, fn, and fp, as these still hold the score of the current program
+                        tp_, fn_, tn_, fp_, hypothesis_size = conf_matrix
+                        settings.best_prog_score = conf_matrix
+                        settings.solution = new_hypothesis
+                        settings.print_incomplete_solution2(new_hypothesis, tp_, fn_, tn_, fp_, hypothesis_size)
+
+                        # the combiner has not seen the programs in to_combine, so we only prune larger programs and let the search finish the current size
+                        settings.max_literals = hypothesis_size-1
+                        for i in range(hypothesis_size, max_size+1):
+                            generator.prune_size(i)
+
                 # BUILD CONSTRAINTS
                 if add_spec and not pruned_more_general and not add_redund2:
                     new_cons.append((Constraint.SPECIALISATION, prog))
@@ -777,9 +814,11 @@ class Popper():
 
                 # CONSTRAIN
                 with settings.stats.duration('constrain'):
-                    pass
-                    # print(new_cons)
-                    generator.constrain(new_cons)
+                    if settings.single_solve and settings.gen_batch_size > 1:
+                        # the constraints from a batch are added together before taking the next batch
+                        self.batch_cons.extend(new_cons)
+                    else:
+                        generator.constrain(new_cons)
 
             # if not pi_or_rec:
             if to_combine:
@@ -814,6 +853,21 @@ class Popper():
                 break
         assert(len(to_combine) == 0)
 
+    def next_batch_prog(self):
+        generator = self.generator
+        while True:
+            if not self.batch:
+                if self.batch_cons:
+                    generator.constrain(self.batch_cons)
+                    self.batch_cons = []
+                self.batch.extend(generator.get_progs(self.settings.gen_batch_size))
+                if not self.batch:
+                    return None
+            prog = self.batch.popleft()
+            # skip programs pruned by the constraints learned from the other programs in the batch
+            if not generator.pruned_by(prog, self.batch_cons):
+                return prog
+
     def filter_combine_programs(self, combiner, to_combine):
 
         # assert(False)
@@ -1100,15 +1154,15 @@ class Popper():
                 continue
             seen.add(k1)
 
-            new_rule = (head, new_body)
-            new_prog = frozenset({new_rule})
+            new_rule = Rule(head, new_body)
+            new_prog = Program([new_rule])
 
             # ensure at least one head variable is in the body
             if not settings.non_datalog_flag and not any(x in head_vars for literal in new_body for x in literal.arguments):
                 continue
 
             # check whether we have pruned any subset (HORRIBLE CODE)
-            if any(frozenset(x) in self.pruned2 for x in non_empty_powerset(new_body)):
+            if self.seen_pruned_subset(new_rule):
                 continue
 
             if not head_connected(new_rule):
@@ -1144,8 +1198,7 @@ class Popper():
 
             # for each pruned program, add the variants to the list of pruned programs
             # doing so reduces the number of pointless checks
-            for x in self.find_variants(remap_variables(new_rule)):
-                self.pruned2.add(x)
+            self.add_pruned(new_rule)
 
             if subsumed:
                 out.add((new_prog, ('SUBSUMED (GENERALISATION)')))
@@ -1163,7 +1216,6 @@ class Popper():
         to_delete = set()
         to_delete_rec = set()
         seen = set()
-        pruned2 = self.pruned2
 
         for index, (prog2, pos_covered2, prog2_size) in enumerate(could_prune_later_rec):
             # AC: TODO: separate this check
@@ -1194,7 +1246,7 @@ class Popper():
             seen.add(body)
 
             # If we have seen a subset of the body then ignore this program
-            if any(frozenset(x) in pruned2 for x in non_empty_powerset(body)):
+            if self.seen_pruned_subset((head, body)):
                 to_delete.add(index)
                 continue
 
@@ -1202,7 +1254,7 @@ class Popper():
 
             # We now enumerate the subsets of the body of this role to find the most general subsumed subset
             for new_body in non_empty_subset(body):
-                new_rule = (head, new_body)
+                new_rule = Rule(head, new_body)
 
                 if not head_connected(new_rule):
                     continue
@@ -1215,7 +1267,7 @@ class Popper():
                     continue
                 seen.add(tmp)
 
-                new_prog = frozenset([new_rule])
+                new_prog = Program([new_rule])
 
                 if tester.has_redundant_literal(new_prog):
                     continue
@@ -1235,8 +1287,7 @@ class Popper():
                 if sub_prog_subsumed or sub_subsumed_by_two:
                     to_prune.add(new_prog)
                     pruned_subprog = True
-                    for x in self.find_variants(remap_variables(new_rule)):
-                        pruned2.add(x)
+                    self.add_pruned(new_rule)
                     break
 
             to_delete.add(index)
@@ -1244,8 +1295,7 @@ class Popper():
             if pruned_subprog:
                 continue
 
-            for x in self.find_variants(remap_variables((head, body))):
-                pruned2.add(x)
+            self.add_pruned((head, body))
 
             if self.settings.showcons:
                 if subsumed:
@@ -1267,7 +1317,6 @@ class Popper():
         to_prune = set()
         to_delete = set()
         seen = set()
-        pruned2 = self.pruned2
 
         if not settings.solution_found:
             return
@@ -1289,7 +1338,7 @@ class Popper():
             seen.add(body)
 
             # If we have seen a subset of the body then ignore this program
-            if any(frozenset(x) in pruned2 for x in non_empty_powerset(body)):
+            if self.seen_pruned_subset((head, body)):
                 to_delete.add(index)
                 continue
 
@@ -1297,7 +1346,7 @@ class Popper():
 
             # We now enumerate the subsets of the body of this role to find the most general subsumed subset
             for new_body in non_empty_subset(body):
-                new_rule = (head, new_body)
+                new_rule = Rule(head, new_body)
 
                 if not head_connected(new_rule):
                     continue
@@ -1310,7 +1359,7 @@ class Popper():
                     continue
                 seen.add(tmp)
 
-                new_prog = frozenset([new_rule])
+                new_prog = Program([new_rule])
 
                 if tester.has_redundant_literal(new_prog):
                     continue
@@ -1323,8 +1372,7 @@ class Popper():
                         print('\t', 'COVERS TOO FEW BACKTRACK (GENERALISATION)', '\t', format_prog(new_prog))
                     to_prune.add(new_prog)
                     pruned_subprog = True
-                    for x in self.find_variants(remap_variables(new_rule)):
-                        pruned2.add(x)
+                    self.add_pruned(new_rule)
                     break
 
             to_delete.add(index)
@@ -1332,8 +1380,7 @@ class Popper():
             if pruned_subprog:
                 continue
 
-            for x in self.find_variants(remap_variables((head, body))):
-                pruned2.add(x)
+            self.add_pruned((head, body))
 
             if self.settings.showcons:
                 print('\t', 'COVERS TOO FEW BACKTRACK', '\t', format_prog(prog2))
@@ -1344,20 +1391,22 @@ class Popper():
 
         return to_prune
 
-    def find_variants(self, rule):
+    # we used to add every variant of a pruned rule to pruned2, which is factorial in max_vars
+    # we now store each pruned body once, indexed by a signature that does not depend on the names of the body variables, and check for a variant on lookup
+    def add_pruned(self, rule):
+        head, body = remap_variables(rule)
+        head_arity = len(head.arguments)
+        self.pruned2[body_signature(body, head_arity)].append(body)
+
+    def seen_pruned_subset(self, rule):
         head, body = rule
-        _head_pred, head_args = head
-        head_arity = len(head_args)
-        body_vars = frozenset(x for literal in body for x in literal.arguments if x >= head_arity)
-        subset = range(head_arity, self.settings.max_vars)
-        for xs in permutations(subset, len(body_vars)):
-            xs = head_args + xs
-            new_body = []
-            for pred, args in body:
-                new_args = tuple(xs[arg] for arg in args)
-                new_literal = (pred, new_args)
-                new_body.append(new_literal)
-            yield frozenset(new_body)
+        head_arity = len(head.arguments)
+        pruned2 = self.pruned2
+        for xs in non_empty_powerset(body):
+            k = body_signature(xs, head_arity)
+            if k in pruned2 and any(is_variant(xs, ys, head_arity) for ys in pruned2[k]):
+                return True
+        return False
 
     def build_test_prog(self, subprog):
         directions = self.settings.directions
@@ -1371,9 +1420,9 @@ class Popper():
             body_literals = set()
             for pred, args in body:
                 body_literals.add(Literal(pred, args))
-            rule = head_literal, frozenset(body_literals)
+            rule = Rule(head_literal, frozenset(body_literals))
             test_prog.append(rule)
-        return frozenset(test_prog)
+        return Program(test_prog)
 
     def explain_totally_incomplete(self, prog):
         return list(self.explain_totally_incomplete_aux2(prog, set(), set()))
@@ -1701,7 +1750,8 @@ def get_bk_cons(settings, tester):
             for x in sorted(xs):
                 print('BKCON', x)
         bkcons.extend(xs)
-    return bkcons
+    # sorted so that the generator encoding (and its ground cache key) does not depend on set order
+    return sorted(bkcons)
 
 def learn_solution(settings):
     t1 = time.time()
@@ -1724,7 +1774,7 @@ def generalisations(prog, allow_headless=True, recursive=False):
 
         if allow_headless:
             if head and len(body) > 0:
-                new_rule = (None, body)
+                new_rule = Rule(None, body)
                 new_prog = [new_rule]
                 yield new_prog
 
@@ -1735,7 +1785,7 @@ def generalisations(prog, allow_headless=True, recursive=False):
                 if recursive and body[i].predicate == head.predicate:
                     continue
                 new_body = body[:i] + body[i+1:]
-                new_rule = (head, frozenset(new_body))
+                new_rule = Rule(head, frozenset(new_body))
                 new_prog = [new_rule]
                 yield new_prog
 
@@ -1832,27 +1882,6 @@ def theory_subsumes(prog1, prog2):
 def seen_more_general_unsat(prog, unsat):
     return any(theory_subsumes(seen, prog) for seen in unsat)
 
-@cache
-def head_connected(rule):
-    head, body = rule
-    head_connected_vars = set(head.arguments)
-    body_literals = set(body)
-
-    if not any(x in head_connected_vars for literal in body for x in literal.arguments):
-        return False
-
-    while body_literals:
-        changed = False
-        for literal in body_literals:
-            if any (x in head_connected_vars for x in literal.arguments):
-                head_connected_vars.update(literal.arguments)
-                body_literals = body_literals.difference({literal})
-                changed = True
-        if changed == False and body_literals:
-            return False
-
-    return True
-
 def is_headless(prog):
     return any(head is None for head, body in prog)
 
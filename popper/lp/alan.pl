@@ -15,15 +15,10 @@ max_size(K):-
     max_body(M),
     max_clauses(N),
     K = (M+1)*N.
-size(N):-
-    max_size(MaxSize),
-    N = 2..MaxSize,
-    #sum{K+1,Rule : body_size(Rule,K)} == N.
 
-%% THIS DOES NOT WORK!!!???
-%% size(N+1):-
-%%     body_size(0,N).
-:- not size(_).
+%% the generator solves one program size at a time. it grounds the size constraint for each size when it reaches it and sets size/1, body_size/2, and program_size_at_least/1 from Python (see gen2.py)
+#external size(N): max_size(MaxSize), N = 2..MaxSize.
+#external program_size_at_least(M): max_size(MaxSize), M = 0..MaxSize.
 
 %% ********** BASE CASE (RULE 0) **********
 head_literal(0,P,A,Vars):-
@@ -48,14 +43,7 @@ clause(C):-
     head_literal(C,_,_,_).
 
 %% NUM BODY LITERALS OF A CLAUSE
-%% TODO: IMPROVE AS EXPENSIVE
-%% grounding is > c * (n choose k), where n = |Herbrand base| and k = MaxN
-body_size(Rule,N):-
-    clause(Rule),
-    max_body(MaxN),
-    N > 0,
-    N <= MaxN,
-    #count{P,Vars : body_literal(Rule,P,_,Vars)} == N.
+#external body_size(0,N): max_body(MaxN), N = 1..MaxN.
 
 %% USE VARS IN ORDER IN A CLAUSE
 :-
@@ -1,223 +1,349 @@
 # code written by Andreas Niskanen (andreas.niskanen@helsinki.fi)
-import os, subprocess, sys, tempfile
+import multiprocessing, multiprocessing.connection, os, random, shutil, signal, subprocess, sys, tempfile, threading, time
 
+from itertools import chain
 from pysat.formula import WCNF
-from pysat.examples.rc2 import RC2Stratified
+from pysat.examples.rc2 import RC2, RC2Stratified
 from pysat.card import *
+from pysat.solvers import Solver
 
-def old_wcnf_to_file(hard_clauses, soft_clauses, weights, file):
-    n_vars = 0
-    for clause in hard_clauses:
-        n_vars = max(n_vars, max([abs(lit) for lit in clause]))
-    for clause in soft_clauses:
-        n_vars = max(n_vars, max([abs(lit) for lit in clause]))
-    n_clauses = len(hard_clauses) + len(soft_clauses) - len([w for w in weights if w == 0])
-    top = sum(weights)+1
-    file.write("p wcnf " + str(n_vars) + " " + str(n_clauses) + " " + str(top) + "\n")
-    for clause in hard_clauses:
-        #print(str(top) + " " + " ".join(map(str, clause)) + " 0")
-        file.write(str(top) + " " + " ".join(map(str, clause)) + " 0" + "\n")
-    for clause, w in zip(soft_clauses, weights):
-        if w == 0:
-            continue
-        #print(str(w) + " " + " ".join(map(str, clause)) + " 0")
-        file.write(str(w) + " " + " ".join(map(str, clause)) + " 0" + "\n")
-    file.flush()
+# builds the text of a WCNF instance. the text of every literal is looked up in a table rather than formatted clause by clause
+class WCNFBuilder:
+    def __init__(self, hard_clauses=[], soft_clauses=[], weights=[]):
+        self.hard = []
+        self.soft = []
+        self.top = 1
+        self.soft_vars = 0
+        self.add_hard(hard_clauses)
+        self.add_soft(soft_clauses, weights)
+
+    def add_hard(self, clauses):
+        self.hard.extend(clauses)
+
+    def add_soft(self, clauses, weights):
+        for clause, w in zip(clauses, weights):
+            if w == 0:
+                continue
+            self.soft.append((w, clause))
+            self.top += w
+            self.soft_vars = max(self.soft_vars, max(map(abs, clause), default=0))
+
+    def to_bytes(self, old_format):
+        lits = list(chain.from_iterable(self.hard))
+        n_vars = max(self.soft_vars, max(lits, default=0), -min(lits, default=0))
+        # the text of every literal, where a negative literal indexes from the end
+        names = [str(i) for i in range(n_vars+1)] + [str(i) for i in range(-n_vars, 0)]
+        hard_prefix = str(self.top) if old_format else 'h'
+        lines = []
+        if old_format:
+            lines.append(f'p wcnf {n_vars} {len(self.hard) + len(self.soft)} {self.top}')
+        for clause in self.hard:
+            lines.append(' '.join([hard_prefix, *map(names.__getitem__, clause), '0']))
+        for w, clause in self.soft:
+            lines.append(' '.join([str(w), *map(names.__getitem__, clause), '0']))
+        lines.append('')
+        return '\n'.join(lines).encode('ascii')
+
+# reads the output of a solver in one pass, keeping the status and the last cost and model
+def parse_solver_output(lines):
+    status = None
+    cost_line = None
+    model_line = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('ascii')
+        line = line.rstrip()
+        if line.startswith('o '):
+            cost_line = line
+        elif line.startswith('v '):
+            model_line = line
+        elif line.startswith('s ') or line == 'UNSATISFIABLE':
+            status = line
+    cost, model = None, None
+    if cost_line is not None:
+        cost = int(cost_line[2:].replace("-oo", "0"))
+    if model_line is not None:
+        model_line = model_line[2:]
+        model = [i if model_line[i-1] == "1" else -i for i in range(1, len(model_line)+1)]
+    return status, cost, model
+
+# the solvers that read the instance from stdin when no file is given
+STDIN_SOLVERS = {'uwrmaxsat'}
+
+# runs a solver on an instance and parses its output
+def run_solver(solver, args, wcnf, old_format, timeout=None):
+    data = wcnf.to_bytes(old_format)
+    if os.path.basename(solver) in STDIN_SOLVERS:
+        with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
+            # communicate writes the instance and reads the output together, so neither pipe can fill up and block the other
+            try:
+                out, _ = proc.communicate(data, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                out, _ = proc.communicate()
+            return parse_solver_output(out.splitlines())
+    with tempfile.NamedTemporaryFile(suffix=".wcnf") as tmp:
+        tmp.write(data)
+        tmp.flush()
+        with subprocess.Popen(args + [tmp.name], stdout=subprocess.PIPE) as proc:
+            return parse_solver_output(proc.stdout)
+
+# phases are the values we would like the solver to try first, such as those of the best solution so far. RC2 renames the variables, so we map them to its names
+def set_rc2_phases(rc2, phases):
+    e2i = rc2.vmap.e2i
+    rc2.oracle.set_phases([e2i[lit] if lit > 0 else -e2i[-lit] for lit in phases if abs(lit) in e2i])
 
-def new_wcnf_to_file(hard_clauses, soft_clauses, weights, file):
+def rc2_solve(hard_clauses, soft_clauses, weights, blo=None, minz=True, phases=[]):
+    wcnf = WCNF()
     for clause in hard_clauses:
-        #print("h " + " ".join(map(str, clause)) + " 0")
-        file.write("h " + " ".join(map(str, clause)) + " 0" + "\n")
+        wcnf.append(clause)
     for clause, w in zip(soft_clauses, weights):
         if w == 0:
             continue
-        #print(str(w) + " " + " ".join(map(str, clause)) + " 0")
-        file.write(str(w) + " " + " ".join(map(str, clause)) + " 0" + "\n")
-    file.flush()
+        wcnf.append(clause, weight=w)
 
-def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings):
+    if blo is None:
+        rc2 = RC2(wcnf, solver='g3', adapt=True, exhaust=True, incr=False, minz=minz, trim=0)
+    else:
+        rc2 = RC2Stratified(wcnf, solver='g3', adapt=True, blo=blo, exhaust=True, incr=False, minz=minz, trim=0)
+    set_rc2_phases(rc2, phases)
+    model = rc2.compute()
+    if model is not None:
+        return rc2.cost, model
+    return float("inf"), None
+
+def external_solve(hard_clauses, soft_clauses, weights, solver, params, old_format):
+    wcnf = WCNFBuilder(hard_clauses, soft_clauses, weights)
+    status, cost, model = run_solver(solver, [solver] + params.split(), wcnf, old_format)
+    if status in ("s UNSATISFIABLE", "UNSATISFIABLE"):
+        return float("inf"), None
+    elif status == "s OPTIMUM FOUND":
+        return cost, model
+    else:
+        return None, None
+
+def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings, phases=[]):
     # print("Calling exact MaxSAT solver!")
     settings.stats.maxsat_calls += 1
     if settings.exact_maxsat_solver == "rc2":
+        return rc2_solve(hard_clauses, soft_clauses, weights, phases=phases)
+    elif settings.exact_maxsat_solver == "portfolio":
+        return portfolio_solve(hard_clauses, soft_clauses, weights, settings.maxsat_portfolio)
+    else:
+        return external_solve(hard_clauses, soft_clauses, weights, settings.exact_maxsat_solver, settings.exact_maxsat_solver_params, settings.old_format)
 
-        wcnf = WCNF()
-        for clause in hard_clauses:
-            wcnf.append(clause)
-        for clause, w in zip(soft_clauses, weights):
-            if w == 0:
-                continue
-            wcnf.append(clause, weight=w)
+# the solvers in the portfolio as (name, function, keyword arguments). the external solvers are only used if they are on the path
+def portfolio_members():
+    members = [
+        ('rc2', rc2_solve, {}),
+        ('rc2-div', rc2_solve, {'blo': 'div'}),
+        ('rc2-cluster', rc2_solve, {'blo': 'cluster', 'minz': False}),
+    ]
+    for solver, params, old_format in [('uwrmaxsat', "-v0 -no-sat -no-bin -m -bm", False), ('wmaxcdcl', "", True)]:
+        if shutil.which(solver):
+            members.append((solver, external_solve, {'solver': solver, 'params': params, 'old_format': old_format}))
+    return members
 
-        rc2 = RC2Stratified(wcnf, solver='g3', adapt=True, exhaust=True, blo='div', incr=False, minz=True, trim=0)
-        model = rc2.compute()
-        if model is not None:
-            return rc2.cost, model
-        return float("inf"), None
-    elif settings.old_format is False:
-        # print('Using new format!')
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".wcnf") as tmp:
-            new_wcnf_to_file(hard_clauses, soft_clauses, weights, tmp)
-            #another = open("test_" + str(settings.stats.maxsat_calls) + ".wcnf", "w")
-            #new_wcnf_to_file(hard_clauses, soft_clauses, weights, another)
-            #another.close()
-            try:
-                # output = subprocess.check_output([os.path.join(os.path.dirname(__file__), settings.exact_maxsat_solver)] + settings.exact_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
-                args = [settings.exact_maxsat_solver] + settings.exact_maxsat_solver_params.split() + [tmp.name]
-                # print(args)
-                output = subprocess.check_output(args).decode("utf-8").split("\n")
-            except subprocess.CalledProcessError as error:
-                output = error.output.decode("utf-8").split("\n")
-        if "s UNSATISFIABLE" in output:
-            return float("inf"), None
-        elif "s OPTIMUM FOUND" in output:
-            cost_line = [line for line in output if line.startswith("o ")][-1]
-            cost = int(cost_line.replace("o ", "").replace("-oo", "0"))
-            model_line = [line for line in output if line.startswith("v ")][-1]
-            model_line = model_line.replace("v ", "")
-            model = [i if model_line[i-1] == "1" else -i for i in range(1, len(model_line)+1)]
-            return cost, model
-        else:
-            # print("ERROR: No optimal solution found.")
-            #for line in output:
-            #   print(line)
-            return None, None
-    else:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".wcnf") as tmp:
-            old_wcnf_to_file(hard_clauses, soft_clauses, weights, tmp)
-            try:
-                # output = subprocess.check_output([os.path.join(os.path.dirname(__file__), settings.exact_maxsat_solver)] + settings.exact_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
-                args = [settings.exact_maxsat_solver] + settings.exact_maxsat_solver_params.split() + [tmp.name]
-                output = subprocess.check_output(args).decode("utf-8").split("\n")
-            except subprocess.CalledProcessError as error:
-                output = error.output.decode("utf-8").split("\n")
-        if "UNSATISFIABLE" in output:
-            return float("inf"), None
-        elif "s OPTIMUM FOUND" in output:
-            cost_line = [line for line in output if line.startswith("o ")][-1]
-            cost = int(cost_line.replace("o ", ""))
-            model_line = [line for line in output if line.startswith("v ")][-1]
-            model_line = model_line.replace("v ", "")
-            model = [i if model_line[i-1] == "1" else -i for i in range(1, len(model_line)+1)]
-            return cost, model
-        else:
-            # print("ERROR: No optimal solution found.")
-            #for line in output:
-            #   print(line)
-            return None, None
-
-def anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout):
-    if settings.old_format is False:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".wcnf") as tmp:
-            new_wcnf_to_file(hard_clauses, soft_clauses, weights, tmp)
+def portfolio_worker(conn, func, hard_clauses, soft_clauses, weights, kwargs):
+    # the worker leads its own process group so that killing the group also kills any external solver it started
+    os.setpgrp()
+    conn.send(func(hard_clauses, soft_clauses, weights, **kwargs))
+    conn.close()
+
+# runs every solver of the portfolio in its own process and returns the first optimum found. the workers are forked so the clauses are not copied through a pipe
+def portfolio_solve(hard_clauses, soft_clauses, weights, members):
+    ctx = multiprocessing.get_context('fork')
+    workers = {}
+    for name, func, kwargs in members:
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=portfolio_worker, args=(send_conn, func, hard_clauses, soft_clauses, weights, kwargs), daemon=True)
+        process.start()
+        send_conn.close()
+        workers[recv_conn] = process
+
+    result = None, None
+    try:
+        while workers and result[0] is None:
+            for conn in multiprocessing.connection.wait(list(workers)):
+                process = workers.pop(conn)
+                try:
+                    cost, model = conn.recv()
+                except EOFError:
+                    continue
+                finally:
+                    conn.close()
+                process.join()
+                # an external solver that stops without an optimum says nothing about the instance
+                if cost is not None:
+                    result = cost, model
+                    break
+    finally:
+        for conn, process in workers.items():
             try:
-                # print('calling anytime')
-                # output = subprocess.check_output(["timeout", str(timeout), os.path.join(os.path.dirname(__file__), settings.anytime_maxsat_solver)] + settings.anytime_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
-                args = ["timeout", "-s", str(settings.anytime_maxsat_solver_signal), str(timeout), settings.anytime_maxsat_solver] + settings.anytime_maxsat_solver_params.split() + [tmp.name]
-                # print(args)
-                output = subprocess.check_output(args).decode("utf-8").split("\n")
-                # print(output)
-            except subprocess.CalledProcessError as error:
-                # print('errr', error)
-                output = error.output.decode("utf-8").split("\n")
-        if "s UNSATISFIABLE" in output:
-            # print('UNSATISFIABLE')
-            return float("inf"), None
-        elif "s OPTIMUM FOUND" in output or "s SATISFIABLE" in output:
-            cost_line = [line for line in output if line.startswith("o ")][-1]
-            cost = int(cost_line.replace("o ", "").replace("-oo", "0"))
-            model_line = [line for line in output if line.startswith("v ")][-1]
-            model_line = model_line.replace("v ", "")
-            model = [i if model_line[i-1] == "1" else -i for i in range(1, len(model_line)+1)]
-            # print('SATISFIABLE', cost)
-            return cost, model
-        else:
-            # print("WARNING: No solution found.")
-            #for line in output:
-            #   print(line)
-            return None, None
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            # the worker may not have its own process group yet
+            process.kill()
+            process.join()
+            conn.close()
+    return result
+
+def anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout, phases=[]):
+    if settings.anytime_maxsat_solver == "lns":
+        return lns_solve(hard_clauses, soft_clauses, weights, timeout, phases)
+    wcnf = WCNFBuilder(hard_clauses, soft_clauses, weights)
+    args = ["timeout", "-s", str(settings.anytime_maxsat_solver_signal), str(timeout), settings.anytime_maxsat_solver] + settings.anytime_maxsat_solver_params.split()
+    # timeout signals the solver, so we only stop it ourselves if it has not finished well after that
+    status, cost, model = run_solver(settings.anytime_maxsat_solver, args, wcnf, settings.old_format, timeout=2*timeout)
+    if status in ("s UNSATISFIABLE", "UNSATISFIABLE"):
+        return float("inf"), None
+    elif status in ("s OPTIMUM FOUND", "s SATISFIABLE"):
+        return cost, model
     else:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".wcnf") as tmp:
-            old_wcnf_to_file(hard_clauses, soft_clauses, weights, tmp)
-            try:
-                # print('calling anytime')
-                # output = subprocess.check_output(["timeout", str(timeout), os.path.join(os.path.dirname(__file__), settings.anytime_maxsat_solver)] + settings.anytime_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
-                output = subprocess.check_output(["timeout", "-s", str(settings.anytime_maxsat_solver_signal), str(timeout), settings.anytime_maxsat_solver] + settings.anytime_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
-                # print(output)
-            except subprocess.CalledProcessError as error:
-                output = error.output.decode("utf-8").split("\n")
-                # print(output, error)
-        if "UNSATISFIABLE" in output:
-            # print('UNSATISFIABLE')
+        return None, None
+
+# the weight of the soft clauses that a model falsifies
+def model_cost(model, soft_clauses, weights):
+    return sum(w for clause, w in zip(soft_clauses, weights) if not any(model[abs(lit)-1] == lit for lit in clause))
+
+# an anytime solver that needs no external binary. we find any model, preferring the phases given, such as those of the best solution so far. we then repeatedly fix the variables of a random part of the soft clauses to their values in the best model and solve the rest exactly with RC2. if RC2 solves a neighbourhood without finding a better model, we grow the neighbourhood, and if it runs out of time, we shrink it. once the neighbourhood is every soft clause, the best model is optimal
+def lns_solve(hard_clauses, soft_clauses, weights, timeout, phases=[]):
+    deadline = time.time() + timeout
+    rng = random.Random(0)
+
+    with Solver(name='g3', bootstrap_with=hard_clauses) as solver:
+        solver.set_phases(phases + [lit for clause in soft_clauses for lit in clause])
+        if not solver.solve():
             return float("inf"), None
-        elif "s OPTIMUM FOUND" in output or "s SATISFIABLE" in output:
-            cost_line = [line for line in output if line.startswith("o ")][-1]
-            cost = int(cost_line.replace("o ", ""))
-            model_line = [line for line in output if line.startswith("v ")][-1]
-            model_line = model_line.replace("v ", "")
-            model = [i if model_line[i-1] == "1" else -i for i in range(1, len(model_line)+1)]
-            # print('SATISFIABLE', cost)
-            return cost, model
-        else:
-            # print("WARNING: No solution found.")
-            #for line in output:
-            #   print(line)
-            return None, None
-
-# lexicographic optimization with non-unit weights on last group
-def exact_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings):
-    assert(len(last_weights) == len(soft_lit_groups[-1]))
-    if not settings.lex_via_weights:
+        model = solver.get_model()
+
+    wcnf = WCNF()
+    for clause in hard_clauses:
+        wcnf.append(clause)
+    for clause, w in zip(soft_clauses, weights):
+        if w > 0:
+            wcnf.append(clause, weight=w)
+    n_vars = max([len(model), wcnf.nv])
+    model = model + [-i for i in range(len(model)+1, n_vars+1)]
+    cost = model_cost(model, soft_clauses, weights)
+
+    soft_vars = sorted(set(abs(lit) for clause in soft_clauses for lit in clause))
+    fraction = 0.2
+    while cost > 0 and time.time() < deadline:
+        free = set(rng.sample(soft_vars, min(len(soft_vars), max(1, int(fraction * len(soft_vars))))))
+        with RC2(wcnf, solver='g3', adapt=True, exhaust=True, incr=False, minz=True, trim=0) as rc2:
+            for var in soft_vars:
+                if var not in free:
+                    rc2.add_clause([model[var-1]])
+            # a neighbourhood gets at most a tenth of the time
+            timer = threading.Timer(max(0, min(timeout / 10, deadline - time.time())), rc2.interrupt)
+            timer.start()
+            new_model = rc2.compute(expect_interrupt=True)
+            timer.cancel()
+
+        if new_model is None:
+            fraction = fraction / 2
+            continue
+        new_model = new_model + [-i for i in range(len(new_model)+1, n_vars+1)]
+        new_cost = model_cost(new_model, soft_clauses, weights)
+        if new_cost < cost:
+            model, cost = new_model, new_cost
+            continue
+        if len(free) == len(soft_vars):
+            break
+        fraction = min(1, fraction * 2)
+
+    return cost, model
+
+# lexicographic optimization with one RC2 instance, so one SAT solver. RC2 relaxes the cores it finds with totalizers whose bounds are assumptions. when a group is optimal, any model with the optimal cost for it satisfies every assumption that still has a weight, so we make these assumptions hard and add the soft literals of the next group. nothing is encoded or solved twice
+def incremental_lex_solve(hard_clauses, soft_lit_groups, weight_groups, phases=[]):
+    wcnf = WCNF()
+    for clause in hard_clauses:
+        wcnf.append(clause)
+    for lit, w in zip(soft_lit_groups[0], weight_groups[0]):
+        if w > 0:
+            wcnf.append([lit], weight=w)
+
+    with RC2(wcnf, solver='g3', adapt=True, exhaust=True, incr=False, minz=True, trim=0) as rc2:
+        set_rc2_phases(rc2, phases)
+        cost, lower = 0, 0
+        for i, (soft_lits, weights) in enumerate(zip(soft_lit_groups, weight_groups)):
+            if i > 0:
+                for lit in rc2.sels + rc2.sums:
+                    rc2.oracle.add_clause([lit])
+                for lit, w in zip(soft_lits, weights):
+                    if w > 0:
+                        rc2.add_clause([lit], weight=w)
+            model = rc2.compute()
+            if model is None:
+                return float("inf"), None
+            cost, lower = rc2.cost - lower, rc2.cost
+        return cost, model
+
+# lexicographic optimization, where weight_groups holds the weights of the literals in each group
+def exact_lex_solve(hard_clauses, soft_lit_groups, weight_groups, settings, phases=[]):
+    assert(all(len(weights) == len(soft_lits) for soft_lits, weights in zip(soft_lit_groups, weight_groups)))
+    if not settings.lex_via_weights and settings.exact_maxsat_solver == "rc2":
+        settings.stats.maxsat_calls += 1
+        return incremental_lex_solve(hard_clauses, soft_lit_groups, weight_groups, phases)
+    elif not settings.lex_via_weights:
+        # the bounds on earlier groups go in a copy so that the caller's clauses are left as they are
+        hard_clauses = list(hard_clauses)
         top_id = 0
         for soft_lits in soft_lit_groups:
             top_id = max(top_id, max([abs(lit) for lit in soft_lits]))
         for clause in hard_clauses:
             top_id = max(top_id, max([abs(lit) for lit in clause]))
-        i=0
-        for soft_lits in soft_lit_groups[:-1]:
-            i=i+1
-            cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], [1 for _ in soft_lits], settings)
+        for soft_lits, weights in zip(soft_lit_groups[:-1], weight_groups[:-1]):
+            cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], weights, settings)
             if model is None:
                 return cost, model
-            card = CardEnc.atmost([-lit for lit in soft_lits], bound=cost, top_id=top_id, encoding=1)
+            # a literal with weight w counts w times towards the bound
+            card = CardEnc.atmost([-lit for lit, w in zip(soft_lits, weights) for _ in range(w)], bound=cost, top_id=top_id, encoding=1)
             for clause in card.clauses:
                 hard_clauses.append(clause)
                 top_id = max(top_id, max([abs(lit) for lit in clause]))
-        cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], last_weights, settings)
+        cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], weight_groups[-1], settings)
         return cost, model
     else:
-        soft_clauses = [[lit] for lit in soft_lit_groups[-1]]
-        weights = [weight for weight in last_weights]
-        next_weight = sum(last_weights)+1
-        for soft_lits in reversed(soft_lit_groups[:-1]):
-            soft_clauses.extend([[lit] for lit in soft_lits])
-            weights.extend([next_weight for _ in soft_lits])
-            next_weight = sum(weights)+1
-        return exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings)
-
-# lexicographic optimization with non-unit weights on last group
-def anytime_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings, timeout):
-    assert(len(last_weights) == len(soft_lit_groups[-1]))
+        soft_clauses, weights = lex_weights(soft_lit_groups, weight_groups)
+        return exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings, phases)
+
+# lexicographic optimization, where weight_groups holds the weights of the literals in each group
+def anytime_lex_solve(hard_clauses, soft_lit_groups, weight_groups, settings, timeout, phases=[]):
+    assert(all(len(weights) == len(soft_lits) for soft_lits, weights in zip(soft_lit_groups, weight_groups)))
+    if settings.anytime_maxsat_solver == "lns":
+        # a neighbourhood is solved exactly, so one objective with lexicographic weights is enough
+        soft_clauses, weights = lex_weights(soft_lit_groups, weight_groups)
+        return lns_solve(hard_clauses, soft_clauses, weights, timeout, phases)
     if not settings.lex_via_weights:
+        hard_clauses = list(hard_clauses)
         top_id = 0
         for soft_lits in soft_lit_groups:
             top_id = max(top_id, max([abs(lit) for lit in soft_lits]))
         for clause in hard_clauses:
             top_id = max(top_id, max([abs(lit) for lit in clause]))
-        for soft_lits in soft_lit_groups[:-1]:
-            cost, model = anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], [1 for _ in soft_lits], settings, timeout)
+        for soft_lits, weights in zip(soft_lit_groups[:-1], weight_groups[:-1]):
+            cost, model = anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], weights, settings, timeout)
             if model is None:
                 return cost, model
-            card = CardEnc.atmost([-lit for lit in soft_lits], bound=cost, top_id=top_id, encoding=1)
+            card = CardEnc.atmost([-lit for lit, w in zip(soft_lits, weights) for _ in range(w)], bound=cost, top_id=top_id, encoding=1)
             for clause in card.clauses:
                 hard_clauses.append(clause)
                 top_id = max(top_id, max([abs(lit) for lit in clause]))
-        return anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], last_weights, settings, timeout)
+        return anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], weight_groups[-1], settings, timeout)
     else:
-        soft_clauses = [[lit] for lit in soft_lit_groups[-1]]
-        weights = [weight for weight in last_weights]
-        next_weight = sum(last_weights)+1
-        for soft_lits in reversed(soft_lit_groups[:-1]):
-            soft_clauses.extend([[lit] for lit in soft_lits])
-            weights.extend([next_weight for _ in soft_lits])
-            next_weight = sum(weights)+1
-        return anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings)
\ No newline at end of file
+        soft_clauses, weights = lex_weights(soft_lit_groups, weight_groups)
+        return anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout, phases)
+
+# the weights of one objective in which each group outweighs all later groups
+def lex_weights(soft_lit_groups, weight_groups):
+    soft_clauses = [[lit] for lit in soft_lit_groups[-1]]
+    weights = [weight for weight in weight_groups[-1]]
+    next_weight = sum(weights)+1
+    for soft_lits, group_weights in zip(reversed(soft_lit_groups[:-1]), reversed(weight_groups[:-1])):
+        soft_clauses.extend([[lit] for lit in soft_lits])
+        weights.extend([next_weight * w for w in group_weights])
+        next_weight = sum(weights)+1
+    return soft_clauses, weights
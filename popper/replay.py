@@ -0,0 +1,99 @@
+# replays the combine instances saved with --capture-combine on each MaxSAT solver and reports how long each takes and its speedup over the first solver. run it with python -m popper.replay DIR
+import argparse
+import glob
+import gzip
+import json
+import os
+import shutil
+import time
+from types import SimpleNamespace
+from . import maxsat
+from . util import ANYTIME_TIMEOUT
+
+# the solvers as (name, settings, whether it is an anytime solver)
+def load_solvers():
+    solvers = [
+        ('rc2', {'exact_maxsat_solver': 'rc2'}, False),
+        ('rc2-weights', {'exact_maxsat_solver': 'rc2', 'lex_via_weights': True}, False),
+        ('portfolio', {'exact_maxsat_solver': 'portfolio', 'maxsat_portfolio': maxsat.portfolio_members()}, False),
+        ('lns', {'anytime_maxsat_solver': 'lns'}, True),
+    ]
+    if shutil.which('uwrmaxsat'):
+        solvers.append(('uwrmaxsat', {'exact_maxsat_solver': 'uwrmaxsat', 'exact_maxsat_solver_params': "-v0 -no-sat -no-bin -m -bm", 'old_format': False}, False))
+    if shutil.which('wmaxcdcl'):
+        solvers.append(('wmaxcdcl', {'exact_maxsat_solver': 'wmaxcdcl', 'exact_maxsat_solver_params': "", 'old_format': True}, False))
+    if shutil.which('NuWLS-c'):
+        solvers.append(('nuwls', {'anytime_maxsat_solver': 'NuWLS-c', 'anytime_maxsat_solver_params': "", 'anytime_maxsat_solver_signal': 15, 'old_format': False}, True))
+    return solvers
+
+def load_instance(path):
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+# the cost of a model, which for a lex objective is the cost of each group
+def instance_cost(instance, model):
+    values = set(model)
+    # a variable missing from the model is false
+    def falsified(lit):
+        return lit not in values and (lit > 0 or -lit in values)
+    if instance['lex']:
+        return tuple(sum(w for lit, w in zip(soft_lits, weights) if falsified(lit)) for soft_lits, weights in zip(instance['soft_lit_groups'], instance['weight_groups']))
+    return sum(w for clause, w in zip(instance['soft_clauses'], instance['weights']) if all(falsified(lit) for lit in clause))
+
+def solve(instance, solver_settings, anytime, timeout):
+    settings = SimpleNamespace(lex_via_weights=False, old_format=False, stats=SimpleNamespace(maxsat_calls=0))
+    for k, v in solver_settings.items():
+        setattr(settings, k, v)
+    hard = instance['hard']
+    phases = instance['phases']
+    if timeout is None:
+        timeout = instance['timeout'] or ANYTIME_TIMEOUT
+    t1 = time.time()
+    if instance['lex'] and anytime:
+        _, model = maxsat.anytime_lex_solve(hard, instance['soft_lit_groups'], instance['weight_groups'], settings, timeout, phases)
+    elif instance['lex']:
+        _, model = maxsat.exact_lex_solve(hard, instance['soft_lit_groups'], instance['weight_groups'], settings, phases)
+    elif anytime:
+        _, model = maxsat.anytime_maxsat_solve(hard, instance['soft_clauses'], instance['weights'], settings, timeout, phases)
+    else:
+        _, model = maxsat.exact_maxsat_solve(hard, instance['soft_clauses'], instance['weights'], settings, phases)
+    duration = time.time() - t1
+    if model is None:
+        return duration, None
+    return duration, instance_cost(instance, model)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the MaxSAT solvers on combine instances saved with --capture-combine')
+    parser.add_argument('path', help='Directory of saved combine instances')
+    parser.add_argument('--solvers', default=None, help='Comma separated solvers to run, the first being the baseline (default: all available)')
+    parser.add_argument('--timeout', type=int, default=None, help='Timeout (seconds) for the anytime solvers (default: the timeout of the saved call)')
+    args = parser.parse_args()
+
+    solvers = load_solvers()
+    if args.solvers:
+        by_name = {name: (name, solver_settings, anytime) for name, solver_settings, anytime in solvers}
+        solvers = [by_name[name] for name in args.solvers.split(',')]
+
+    paths = sorted(glob.glob(os.path.join(args.path, '*.json.gz')))
+    names = [name for name, _, _ in solvers]
+    print('instance', *names, sep='\t')
+
+    totals = [0 for _ in solvers]
+    for path in paths:
+        instance = load_instance(path)
+        results = [solve(instance, solver_settings, anytime, args.timeout) for _, solver_settings, anytime in solvers]
+        costs = [cost for _, cost in results if cost is not None]
+        best = min(costs) if costs else None
+        base = results[0][0]
+        row = []
+        for i, (duration, cost) in enumerate(results):
+            totals[i] += duration
+            # a star marks a solver that did not find the best cost of any solver
+            flag = '' if cost == best else '*'
+            row.append(f'{duration:.2f}s ({base / max(duration, 1e-6):.2f}x){flag}')
+        print(os.path.basename(path), *row, sep='\t')
+
+    print('total', *[f'{total:.2f}s ({totals[0] / max(total, 1e-6):.2f}x)' for total in totals], sep='\t')
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ import clingo.script
 import signal
 import argparse
 import os
+import re
+import hashlib
 import logging
 from itertools import permutations, chain, combinations
 from collections import defaultdict
@@ -29,6 +31,9 @@ MAX_EXAMPLES=10000
 BATCH_SIZE=20000
 ANYTIME_TIMEOUT=10
 BKCONS_TIMEOUT=10
+THREADS=1
+GEN_BATCH_SIZE=1
+COVERAGE_LEVELS=10
 
 class Constraint:
     GENERALISATION = 1
@@ -39,6 +44,225 @@ class Constraint:
     TMP_ANDY = 6
     BANISH = 7
 
+CONSTRAINT_NAMES = {v:k.lower() for k, v in vars(Constraint).items() if isinstance(v, int)}
+
+# a rule is a (head, body) pair. we precompute the properties that the loop asks for over and over again (size, recursion, variables) when the rule is built so that they are attribute lookups rather than walks over the body. a Rule hashes and compares equal to the plain tuple (head, body), so both forms can be mixed freely.
+class Rule:
+    __slots__ = ('head', 'body', 'size', 'recursive', 'vars', 'connected', '_hash')
+
+    def __init__(self, head, body):
+        self.head = head
+        self.body = body
+        self.size = 1 + len(body)
+        self.vars = frozenset(x for _pred, args in body for x in args)
+        self.recursive = False
+        if head:
+            head_pred, head_args = head
+            self.vars = self.vars.union(head_args)
+            self.recursive = any(head_pred == pred for pred, _args in body)
+        self.connected = None
+        self._hash = hash((head, body))
+
+    def __iter__(self):
+        yield self.head
+        yield self.body
+
+    def __getitem__(self, i):
+        return (self.head, self.body)[i]
+
+    def __len__(self):
+        return 2
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Rule):
+            return self._hash == other._hash and self.head == other.head and self.body == other.body
+        if isinstance(other, tuple):
+            return (self.head, self.body) == other
+        return NotImplemented
+
+    def __reduce__(self):
+        return (Rule, (self.head, self.body))
+
+    def __repr__(self):
+        return repr((self.head, self.body))
+
+class Program(frozenset):
+    __slots__ = ('size', 'recursive', 'invention')
+
+    def __new__(cls, rules=()):
+        prog = super().__new__(cls, rules)
+        prog.size = sum(calc_rule_size(rule) for rule in prog)
+        prog.recursive = len(prog) > 1 and any(rule_is_recursive(rule) for rule in prog)
+        prog.invention = len(prog) > 1 and any(rule_is_invented(rule) for rule in prog)
+        return prog
+
+    def __reduce__(self):
+        return (Program, (frozenset(self),))
+
+# the body-only variables of a clause must be numbered in order of their first (predicate, argument position) and then by their number of occurrences. sorting the variables of any clause by this order gives a renaming that satisfies the constraints, so at least one variant of each clause remains
+SYMMETRY_BREAKING = """
+sym_occ(C,V,(P,Pos),Vars):- body_literal(C,P,_,Vars), var_pos(V,Vars,Pos), head_literal(C,_,A,_), V >= A.
+sym_first(C,V,K):- body_var(C,V), head_literal(C,_,A,_), V >= A, K = #min{X : sym_occ(C,V,X,_)}.
+sym_count(C,V,N):- body_var(C,V), head_literal(C,_,A,_), V >= A, N = #count{X,Vars : sym_occ(C,V,X,Vars)}.
+:- sym_first(C,V,K1), sym_first(C,W,K2), V < W, K2 < K1.
+:- sym_first(C,V,K), sym_first(C,W,K), V < W, sym_count(C,V,N1), sym_count(C,W,N2), N1 < N2.
+"""
+
+# deduced facts such as prop(ab_ba,(P,P)) fix the order of the arguments of a literal (bad_body in alan.pl). with the directions, that order can rule out the only variant of a clause that the symmetry breaking constraints keep, so we drop these facts when breaking symmetries
+def symmetry_breaking_bkcons(bkcons):
+    out = []
+    for con in bkcons:
+        m = re.fullmatch(r'prop\(([a-z]+)_([a-z]+),\((\w+),\3\)\)\.', con)
+        if m and sorted(m.group(1)) == sorted(m.group(2)):
+            continue
+        out.append(con)
+    return out
+
+# the level of a body literal is the best coverage of a consistent rule with its predicate. the levels are below those of the size heuristic, so they only order the programs of the same size
+COVERAGE_HEURISTIC = f"""
+#external pred_pref(P,L) : body_pred(P,_), L=1..{COVERAGE_LEVELS}.
+#heuristic body_literal(R,P,A,Vars) : max_clauses(N), R=0..N-1, body_pred(P,A), vars(A,Vars), pred_pref(P,L). [L,true]
+"""
+
+class CoverageHeuristic:
+    def __init__(self):
+        self.best = {}
+        self.assigned = {}
+
+    # coverage is the fraction of the positive examples covered by a consistent program
+    def record(self, prog, coverage):
+        level = 1 + int(coverage * (COVERAGE_LEVELS-1))
+        for rule in prog:
+            for pred, _ in rule[1]:
+                if level > self.best.get(pred, 0):
+                    self.best[pred] = level
+
+    # clingo cannot change externals whilst solving, so the generators call this between solve calls
+    def update(self, solver):
+        for pred, level in self.best.items():
+            old_level = self.assigned.get(pred)
+            if old_level == level:
+                continue
+            if old_level is not None:
+                solver.assign_external(clingo.Function('pred_pref', [clingo.Function(pred), clingo.Number(old_level)]), False)
+            solver.assign_external(clingo.Function('pred_pref', [clingo.Function(pred), clingo.Number(level)]), True)
+            self.assigned[pred] = level
+
+# stores the ground nogoods given to the solver so that we do not add a nogood that is a superset of one we already have. the nogoods are kept in a set-trie over literal ids, so a subset query only walks the paths made of literals in the new nogood.
+class NogoodStore:
+    def __init__(self, stats):
+        self.stats = stats
+        self.ids = {}
+        self.trie = {}
+
+    def subsumed(self, ids):
+        stack = [(self.trie, 0)]
+        n = len(ids)
+        while stack:
+            node, i = stack.pop()
+            if None in node:
+                return True
+            for j in range(i, n):
+                child = node.get(ids[j])
+                if child is not None:
+                    stack.append((child, j+1))
+        return False
+
+    def add(self, nogood, con_type):
+        lit_ids = self.ids
+        ids = []
+        for lit in nogood:
+            if lit not in lit_ids:
+                lit_ids[lit] = len(lit_ids)
+            ids.append(lit_ids[lit])
+        ids.sort()
+        if self.subsumed(ids):
+            self.stats.nogoods_skipped[con_type] += 1
+            return False
+        node = self.trie
+        for k in ids:
+            if k not in node:
+                node[k] = {}
+            node = node[k]
+        node[None] = True
+        self.stats.nogoods_added[con_type] += 1
+        self.stats.nogood_literals[con_type] += len(ids)
+        return True
+
+# maps the symbol of every body_literal/4 atom to its rule index and literal. we build it once after grounding, so decoding a model is a dict lookup per atom rather than unpacking the arguments of every symbol
+def body_literal_table(solver):
+    table = {}
+    for atom in solver.symbolic_atoms.by_signature('body_literal', 4):
+        rule_index, pred, _, args = atom.symbol.arguments
+        table[atom.symbol] = (rule_index.number, Literal(pred.name, tuple(x.number for x in args.arguments)))
+    return table
+
+def symbol_to_arg(symbol):
+    if symbol.type == clingo.SymbolType.Number:
+        return symbol.number
+    if symbol.name == '':
+        return tuple(symbol_to_arg(x) for x in symbol.arguments)
+    return symbol.name
+
+def arg_to_symbol(arg):
+    if isinstance(arg, tuple):
+        return clingo.Tuple_(tuple(arg_to_symbol(a) for a in arg))
+    if isinstance(arg, str):
+        return clingo.Function(arg)
+    return clingo.Number(arg)
+
+# maps an atom (pred, args) to its program literal. we fill it from the symbolic atoms after grounding, so a nogood is a list of ints rather than a list of symbols. the key is the atom itself, so two atoms never share an entry
+class AtomLiterals(dict):
+    def __init__(self, solver, signatures):
+        self.solver = solver
+        for pred, arity in signatures:
+            for atom in solver.symbolic_atoms.by_signature(pred, arity):
+                self[(pred, tuple(symbol_to_arg(x) for x in atom.symbol.arguments))] = atom.literal
+
+    # atoms added later, such as seen_rule atoms added through the backend. we do not store misses because the atom may be added later
+    def __missing__(self, k):
+        pred, args = k
+        atom = self.solver.symbolic_atoms[clingo.Function(pred, [arg_to_symbol(x) for x in args])]
+        if atom is None:
+            return None
+        literal = self[k] = atom.literal
+        return literal
+
+    # returns None if the nogood can never be violated because it has an atom that does not exist
+    def nogood(self, ground_body):
+        nogood = []
+        for sign, pred, args in ground_body:
+            literal = self[(pred, args)]
+            if literal is None:
+                if sign:
+                    return None
+                continue
+            nogood.append(literal if sign else -literal)
+        return nogood
+
+NOGOOD_SIGNATURES = [('body_literal', 4), ('body_size', 2), ('size', 1), ('program_size_at_least', 1), ('seen_rule', 2)]
+
+# maps a tuple of clingo numbers to a tuple of ints
+class AtomArgs(dict):
+    def __missing__(self, k):
+        args = self[k] = tuple(x.number for x in k)
+        return args
+
+# maps (pred, args) to the args in the positions with the given direction
+class LiteralArgs(dict):
+    def __init__(self, directions, direction):
+        self.directions = directions
+        self.direction = direction
+
+    def __missing__(self, k):
+        pred, args = k
+        directions = self.directions[pred]
+        xs = self[k] = frozenset(arg for i, arg in enumerate(args) if directions[i] == self.direction)
+        return xs
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Popper is an ILP system based on learning from failures')
 
@@ -55,8 +279,14 @@ def parse_args():
     parser.add_argument('--quiet', '-q', default=False, action='store_true', help='Hide information during learning')
     parser.add_argument('--debug', default=False, action='store_true', help='Print debugging information to stderr')
     parser.add_argument('--showcons', default=False, action='store_true', help='Show constraints deduced during the search')
-    parser.add_argument('--solver', default='rc2', choices=['clingo', 'rc2', 'uwr', 'wmaxcdcl'], help='Select a solver for the combine stage (default: rc2)')
-    parser.add_argument('--anytime-solver', default=None, choices=['wmaxcdcl', 'nuwls'], help='Select an anytime MaxSAT solver (default: None)')
+    parser.add_argument('--solver', default='rc2', choices=['clingo', 'rc2', 'uwr', 'wmaxcdcl', 'portfolio'], help='Select a solver for the combine stage (default: rc2)')
+    parser.add_argument('--anytime-solver', default=None, choices=['wmaxcdcl', 'nuwls', 'lns'], help='Select an anytime MaxSAT solver (default: None)')
+    parser.add_argument('--threads', type=int, default=THREADS, help=f'Number of threads used by the generator to find programs (default: {THREADS})')
+    parser.add_argument('--gen-batch-size', type=int, default=GEN_BATCH_SIZE, help=f'Number of programs to take from the generator at once (default: {GEN_BATCH_SIZE})')
+    parser.add_argument('--coverage-heuristic', default=False, action='store_true', help='Prefer body predicates that appear in consistent rules with high coverage when generating programs')
+    parser.add_argument('--symmetry-breaking', default=False, action='store_true', help='Only generate one variant of each rule up to renaming of its body variables')
+    parser.add_argument('--ground-cache', default=None, help='Directory in which to cache the ground generator program between runs (default: None)')
+    parser.add_argument('--capture-combine', default=None, help='Directory in which to save the MaxSAT instance of every combine call (default: None)')
     parser.add_argument('--anytime-timeout', type=int, default=ANYTIME_TIMEOUT, help=f'Maximum timeout (seconds) for each anytime MaxSAT call (default: {ANYTIME_TIMEOUT})')
     parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help=f'Combine batch size (default: {BATCH_SIZE})')
     parser.add_argument('--functional-test', default=False, action='store_true', help='Run functional test')
@@ -103,6 +333,9 @@ class Stats:
         self.exec_start = perf_counter()
         self.total_programs = 0
         self.durations = {}
+        self.nogoods_added = defaultdict(int)
+        self.nogoods_skipped = defaultdict(int)
+        self.nogood_literals = defaultdict(int)
 
     def total_exec_time(self):
         return perf_counter() - self.exec_start
@@ -116,6 +349,11 @@ class Stats:
             message += f'{summary.operation}:\n\tCalled: {summary.called} times \t ' + \
                        f'Total: {summary.total:0.2f} \t Mean: {summary.mean:0.4f} \t ' + \
                        f'Max: {summary.maximum:0.3f} \t Percentage: {percentage}%\n'
+        for con_type in sorted(self.nogoods_added.keys() | self.nogoods_skipped.keys()):
+            added = self.nogoods_added[con_type]
+            mean_size = self.nogood_literals[con_type]/added if added else 0
+            message += f'Nogoods {CONSTRAINT_NAMES[con_type]}:\n\tAdded: {added} \t ' + \
+                       f'Subsumed: {self.nogoods_skipped[con_type]} \t Mean size: {mean_size:0.2f}\n'
         message += f'Total operation time: {total_op_time:0.2f}s\n'
         message += f'Total execution time: {self.total_exec_time():0.2f}s'
         print(message)
@@ -163,9 +401,13 @@ def format_rule(rule):
     return f'{head_str}:- {body_str}.'
 
 def calc_prog_size(prog):
+    if isinstance(prog, Program):
+        return prog.size
     return sum(calc_rule_size(rule) for rule in prog)
 
 def calc_rule_size(rule):
+    if isinstance(rule, Rule):
+        return rule.size
     head, body = rule
     return 1 + len(body)
 
@@ -181,18 +423,24 @@ def order_prog(prog):
     return sorted(list(prog), key=lambda rule: (rule_is_recursive(rule), len(rule[1])))
 
 def rule_is_recursive(rule):
+    if isinstance(rule, Rule):
+        return rule.recursive
     head, body = rule
-    head_pred, _head_args = head
     if not head:
         return False
+    head_pred, _head_args = head
     return any(head_pred == pred for pred, _args in body)
 
 def prog_is_recursive(prog):
+    if isinstance(prog, Program):
+        return prog.recursive
     if len(prog) < 2:
         return False
     return any(rule_is_recursive(rule) for rule in prog)
 
 def prog_has_invention(prog):
+    if isinstance(prog, Program):
+        return prog.invention
     if len(prog) < 2:
         return False
     return any(rule_is_invented(rule) for rule in prog)
@@ -219,7 +467,7 @@ def flatten(xs):
     return [item for sublist in xs for item in sublist]
 
 class Settings:
-    def __init__(self, cmd_line=False, info=True, debug=False, show_stats=True, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, max_examples=MAX_EXAMPLES, max_body=None, max_rules=None, max_vars=None, functional_test=False, kbpath=False, ex_file=False, bk_file=False, bias_file=False, showcons=False, no_bias=False, order_space=False, noisy=False, batch_size=BATCH_SIZE, solver='rc2', anytime_solver=None, anytime_timeout=ANYTIME_TIMEOUT):
+    def __init__(self, cmd_line=False, info=True, debug=False, show_stats=True, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, max_examples=MAX_EXAMPLES, max_body=None, max_rules=None, max_vars=None, functional_test=False, kbpath=False, ex_file=False, bk_file=False, bias_file=False, showcons=False, no_bias=False, order_space=False, noisy=False, batch_size=BATCH_SIZE, solver='rc2', anytime_solver=None, anytime_timeout=ANYTIME_TIMEOUT, threads=THREADS, gen_batch_size=GEN_BATCH_SIZE, ground_cache=None, coverage_heuristic=False, symmetry_breaking=False, capture_combine=None):
 
         if cmd_line:
             args = parse_args()
@@ -245,6 +493,12 @@ class Settings:
             solver = args.solver
             anytime_solver = args.anytime_solver
             anytime_timeout = args.anytime_timeout
+            threads = args.threads
+            gen_batch_size = args.gen_batch_size
+            ground_cache = args.ground_cache
+            coverage_heuristic = args.coverage_heuristic
+            symmetry_breaking = args.symmetry_breaking
+            capture_combine = args.capture_combine
         else:
             if kbpath:
                 self.bk_file, self.ex_file, self.bias_file = load_kbpath(kbpath)
@@ -286,6 +540,12 @@ class Settings:
         self.solver = solver
         self.anytime_solver = anytime_solver
         self.anytime_timeout = anytime_timeout
+        self.threads = threads
+        self.gen_batch_size = gen_batch_size
+        self.ground_cache = ground_cache
+        self.coverage_heuristic = coverage_heuristic
+        self.symmetry_breaking = symmetry_breaking
+        self.capture_combine = capture_combine
         self.bkcons_timeout = BKCONS_TIMEOUT
 
         self.recall = {}
@@ -390,49 +650,10 @@ class Settings:
 
         # print(directions)
 
-        self.cached_atom_args = {}
-        for i in range(1, self.max_arity+1):
-            for args in permutations(range(0, self.max_vars), i):
-                k = tuple(clingo.Number(x) for x in args)
-                self.cached_atom_args[k] = args
-
-        self.cached_literals = {}
-        self.literal_inputs = {}
-        self.literal_outputs = {}
-
-        if self.has_directions:
-            head_pred, head_args = self.head_literal
-            # print('head_args', head_args)
-            for head_args in permutations(range(self.max_vars), len(head_args)):
-                head_inputs = frozenset(arg for i, arg in enumerate(head_args) if directions[head_pred][i] == '+')
-                head_outputs = frozenset(arg for i, arg in enumerate(head_args) if directions[head_pred][i] == '-')
-                self.literal_inputs[(head_pred, head_args)] = head_inputs
-                self.literal_outputs[(head_pred, head_args)] = head_outputs
-
-        for pred, arity in self.body_preds:
-            for k, args in self.cached_atom_args.items():
-                if len(args) != arity:
-                    continue
-                literal = Literal(pred, args)
-                self.cached_literals[(pred, k)] = literal
-                if self.has_directions:
-                    self.literal_inputs[(pred, args)] = frozenset(arg for i, arg in enumerate(args) if directions[pred][i] == '+')
-                    self.literal_outputs[(pred, args)] = frozenset(arg for i, arg in enumerate(args) if directions[pred][i] == '-')
-
-        # for k, vs in self.literal_inputs.items():
-            # print(k, vs)
-        # print('head_inputs', head_inputs)
-        # print('head_outputs', head_outputs)
-        # exit()
-
-        pred = self.head_literal.predicate
-        arity = len(self.head_literal.arguments)
-
-        for k, args in self.cached_atom_args.items():
-            if len(args) != arity:
-                continue
-            literal = Literal(pred, args)
-            self.cached_literals[(pred, k)] = literal
+        # these tables used to be filled for every permutation of the variables, which grows factorially with max_vars, so we now fill them on demand
+        self.cached_atom_args = AtomArgs()
+        self.literal_inputs = LiteralArgs(directions, '+')
+        self.literal_outputs = LiteralArgs(directions, '-')
 
         if self.max_rules == None:
             if self.recursion_enabled or self.pi_enabled:
@@ -441,6 +662,8 @@ class Settings:
                 self.max_rules = 1
 
         self.head_types, self.body_types = load_types(self)
+        # the type of each head variable, which a body variable must share to be bound to it
+        self.head_var_types = {} if self.head_types is None else dict(enumerate(self.head_types))
 
 
         if len(self.body_types) > 0 or not self.head_types is None:
@@ -676,9 +899,16 @@ def bias_order(settings, max_size):
 def is_headless(prog):
     return any(head is None for head, body in prog)
 
-@cache
 def head_connected(rule):
+    if isinstance(rule, Rule):
+        if rule.connected is None:
+            rule.connected = _head_connected(rule.head, rule.body)
+        return rule.connected
     head, body = rule
+    return _head_connected(head, body)
+
+@cache
+def _head_connected(head, body):
     _head_pred, head_args = head
     head_connected_vars = set(head_args)
     body_literals = set(body)
@@ -699,7 +929,6 @@ def head_connected(rule):
 
     return True
 
-import os
 # AC: I do not know what this code below really does, but it works
 class suppress_stdout_stderr(object):
     '''
@@ -784,7 +1013,199 @@ def remap_variables(rule):
         new_atom = Literal(pred, tuple(new_args))
         new_body.append(new_atom)
 
-    return head, frozenset(new_body)
+    return Rule(head, frozenset(new_body))
+
+# a key for a body that is the same for all renamings of its non-head variables
+def body_signature(body, head_arity):
+    return tuple(sorted((pred, tuple(x if x < head_arity else -1 for x in args)) for pred, args in body))
+
+# is there an injective renaming of the non-head variables of small that maps it into big?
+def embeds(small, big, head_arity):
+    index = defaultdict(list)
+    for pred, args in big:
+        index[pred].append(args)
+    small = sorted(small, key=lambda literal: len(index[literal[0]]))
+    mapping = {}
+    used = set()
+
+    def match(i):
+        if i == len(small):
+            return True
+        pred, args = small[i]
+        for big_args in index[pred]:
+            if len(big_args) != len(args):
+                continue
+            new = {}
+            ok = True
+            for x, y in zip(args, big_args):
+                if x < head_arity or y < head_arity:
+                    if x != y:
+                        ok = False
+                        break
+                    continue
+                v = mapping.get(x, new.get(x))
+                if v is None:
+                    if y in used or y in new.values():
+                        ok = False
+                        break
+                    new[x] = y
+                elif v != y:
+                    ok = False
+                    break
+            if not ok:
+                continue
+            mapping.update(new)
+            used.update(new.values())
+            if match(i+1):
+                return True
+            for x, y in new.items():
+                del mapping[x]
+                used.discard(y)
+        return False
+
+    return match(0)
+
+# the type of each variable of a body that appears in a typed predicate
+def body_var_types(body, body_types):
+    types = {}
+    for pred, args in body:
+        if pred in body_types:
+            for x, t in zip(args, body_types[pred]):
+                types[x] = t
+    return types
+
+# yields every injective mapping from xs to values in which a variable with a type is only mapped to a value with the same type or with no type. value_types holds the types of the head variables. we only try the values each variable can take, rather than filtering every permutation
+def typed_bindings(xs, values, var_types=None, value_types=None):
+    if var_types is None:
+        var_types = {}
+    if value_types is None:
+        value_types = {}
+    xs = list(xs)
+    values = list(values)
+    candidates = []
+    for x in xs:
+        t = var_types.get(x)
+        if t is None:
+            candidates.append(values)
+        else:
+            candidates.append([y for y in values if value_types.get(y, t) == t])
+
+    if all(len(ys) == len(values) for ys in candidates):
+        for ys in permutations(values, len(xs)):
+            yield dict(zip(xs, ys))
+        return
+
+    order = sorted(range(len(xs)), key=lambda i: len(candidates[i]))
+    assignment = {}
+    used = set()
+
+    def bind(i):
+        if i == len(order):
+            yield dict(assignment)
+            return
+        x = xs[order[i]]
+        for y in candidates[order[i]]:
+            if y in used:
+                continue
+            assignment[x] = y
+            used.add(y)
+            yield from bind(i+1)
+            used.discard(y)
+        assignment.pop(x, None)
+
+    yield from bind(0)
+
+# bindings of the variables of an unsatisfiable body to the variables of a rule
+def find_deep_bindings(body, settings):
+    xs = sorted({x for _pred, args in body for x in args})
+    if len(settings.body_types) == 0 or settings.head_types is None:
+        return typed_bindings(xs, range(settings.max_vars))
+    return typed_bindings(xs, range(settings.max_vars), body_var_types(body, settings.body_types), settings.head_var_types)
+
+def is_variant(body1, body2, head_arity):
+    return len(body1) == len(body2) and embeds(body1, body2, head_arity)
 
 def format_prog(prog):
-    return '\n'.join(format_rule(rule) for rule in prog)
\ No newline at end of file
+    return '\n'.join(format_rule(rule) for rule in prog)
+
+# vars/2 and var_pos/3 hold for every permutation of the variables, so we let clingo derive them rather than writing factorially many facts
+def vars_encoding(arities):
+    encoding = []
+    for arity in sorted(arities):
+        xs = [f'V{i}' for i in range(arity)]
+        if arity == 1:
+            args = '(V0,)'
+        else:
+            args = f'({",".join(xs)})'
+        body = [f'var({x})' for x in xs] + [f'{x}!={y}' for x, y in combinations(xs, 2)]
+        if body:
+            encoding.append(f'vars({arity},{args}):- {",".join(body)}.')
+        else:
+            encoding.append(f'vars({arity},{args}).')
+        for i, x in enumerate(xs):
+            encoding.append(f'var_pos({x},{args},{i}):- vars({arity},{args}).')
+    return '\n'.join(encoding)
+
+# the ground base program of a generator only depends on the encoding text, so we save it in aspif and load it on later runs
+GROUND_CACHE_VERSION = 1
+
+class GroundObserver:
+    def __init__(self):
+        self.active = True
+        self.lines = []
+
+    def rule(self, choice, head, body):
+        if self.active:
+            self.lines.append(' '.join(map(str, [1, int(choice), len(head), *head, 0, len(body), *body])))
+
+    def weight_rule(self, choice, head, lower, body):
+        if self.active:
+            xs = [1, int(choice), len(head), *head, 1, lower, len(body)]
+            for lit, weight in body:
+                xs.extend((lit, weight))
+            self.lines.append(' '.join(map(str, xs)))
+
+    def external(self, atom, value):
+        if self.active:
+            self.lines.append(f'5 {atom} {value.value}')
+
+    def heuristic(self, atom, type_, bias, priority, condition):
+        if self.active:
+            self.lines.append(' '.join(map(str, [7, type_.value, atom, bias, priority, len(condition), *condition])))
+
+def ground_cache_path(settings, encoding):
+    key = hashlib.sha256(f'{GROUND_CACHE_VERSION}\n{clingo.__version__}\n{encoding}'.encode()).hexdigest()
+    return os.path.join(settings.ground_cache, f'{key}.aspif')
+
+def ground_base(settings, solver, encoding):
+    if not settings.ground_cache:
+        solver.add('base', [], encoding)
+        solver.ground([('base', [])])
+        return
+
+    path = ground_cache_path(settings, encoding)
+    if os.path.isfile(path):
+        solver.load(path)
+        # every atom has an output statement in the cache file so that clingo knows its symbol, so we ground the show directives again to hide them
+        solver.add('base', [], '\n'.join(re.findall(r'#show\s+\w+/\d+\s*\.', encoding)))
+        solver.ground([('base', [])])
+        return
+
+    observer = GroundObserver()
+    solver.register_observer(observer)
+    solver.add('base', [], encoding)
+    solver.ground([('base', [])])
+    observer.active = False
+
+    lines = ['asp 1 0 0']
+    lines.extend(observer.lines)
+    for atom in solver.symbolic_atoms:
+        symbol = str(atom.symbol)
+        lines.append(f'4 {len(symbol)} {symbol} 1 {atom.literal}')
+    lines.append('0')
+
+    os.makedirs(settings.ground_cache, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)